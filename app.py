@@ -1,34 +1,63 @@
-import streamlit as st
 from typing import List, Dict, Optional, Any
 from datetime import datetime
-from collections import deque
+from collections import deque, OrderedDict
 import ollama
 import json
 from pathlib import Path
 import pickle
+import sqlite3
 import random
+import re
 import os
+import sys
+import uuid
 import subprocess
+import shutil
+import threading
+import atexit
+import queue
 import time
-import numpy as np
+import hashlib
+import bisect
+import contextvars
+import tempfile
+import wave
+import io
 import base64
 import asyncio
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, AsyncExitStack, contextmanager
 from fastapi.staticfiles import StaticFiles
 
 # Create FastAPI app with lifespan
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    global chat_client
+    global chat_client, request_limiter, session_registry, startup_task, analysis_queue, health_task
     chat_client = ChatClient(model="llama3.1:8b")
+    request_limiter = RequestLimiter()
+    session_registry = SessionRegistry(max_history=chat_client.max_history)
+    # Analysis only runs while no interactive request is waiting and a slot is free
+    analysis_queue = AnalysisQueue(
+        is_busy=lambda: request_limiter.waiting > 0 or request_limiter.in_flight >= request_limiter.max_in_flight
+    )
+    # Check and warm the model in the background so the port binds immediately
+    startup_task = asyncio.create_task(chat_client.prepare())
+    if len(chat_client.backends.backends) > 1:
+        health_task = asyncio.create_task(chat_client.backends.run_health_checks())
     yield
     # Shutdown
+    if startup_task and not startup_task.done():
+        startup_task.cancel()
+    if health_task:
+        health_task.cancel()
+    if analysis_queue:
+        await analysis_queue.close()
     if chat_client:
+        chat_client.tts.close()
         chat_client = None
 
 app = FastAPI(lifespan=lifespan)
@@ -45,36 +74,1146 @@ app.add_middleware(
 # Create a Pydantic model for the chat request
 class ChatRequest(BaseModel):
     message: str
+    session_id: Optional[str] = None
+    # /chat/ws only: send the reply audio as binary Ogg/Opus frames after the "done" event
+    stream_audio: bool = False
 
 # Create a global chat client
 chat_client = None
 
+# Latency metrics, rendered in the Prometheus text format at /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(labelnames, values, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values."""
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items()]
+        for labels, counts, total, count in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Counter:
+    """Monotonic counter keyed by label values."""
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Gauge:
+    """Value read from a callback when metrics are scraped.
+
+    With ``labelnames``, the callback returns a dict of label-value tuples to values.
+    """
+    def __init__(self, name: str, help: str, read, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labelnames = labelnames
+
+    def render(self) -> List[str]:
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if not self.labelnames:
+            return lines + [f"{self.name} {value}"]
+        for labels, labelled_value in value.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {labelled_value}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+STAGE_SECONDS = METRICS.register(Histogram(
+    "chat_stage_seconds",
+    "Time spent in each request stage (queue_wait, ttft, prefill, generation, tts, tts_synthesis, tts_sentence, first_audio, audio_postprocess, total).",
+    labelnames=("stage",)
+))
+GENERATION_TOKENS_PER_SECOND = METRICS.register(Histogram(
+    "chat_generation_tokens_per_second",
+    "Decode speed reported by Ollama per completion.",
+    buckets=(5, 10, 20, 30, 40, 60, 80, 120, 160, 240)
+))
+REQUESTS_TOTAL = METRICS.register(Counter(
+    "chat_requests_total",
+    "Chat requests by endpoint and outcome.",
+    labelnames=("endpoint", "outcome")
+))
+TTS_REQUESTS_TOTAL = METRICS.register(Counter(
+    "tts_requests_total",
+    "Speech synthesis requests by cache result.",
+    labelnames=("cache",)
+))
+CANCELLED_TOTAL = METRICS.register(Counter(
+    "chat_cancelled_total",
+    "Work abandoned because the client disconnected, by stage (generation, tts_synthesis).",
+    labelnames=("stage",)
+))
+
+class RequestTrace:
+    """Timing spans of one request; every span is also recorded in STAGE_SECONDS."""
+    __slots__ = ("spans",)
+
+    def __init__(self):
+        self.spans = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage)
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def as_millis(self) -> Dict[str, float]:
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.spans.items()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.as_millis().items())
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Record a stage duration on the current request's trace, or only in the histogram."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(stage, seconds)
+    else:
+        STAGE_SECONDS.observe(seconds, stage)
+
+def record_generation_stats(response) -> None:
+    """Record prefill time and decode speed from an Ollama final response."""
+    prompt_eval_duration = response.get('prompt_eval_duration')
+    if prompt_eval_duration:
+        record_stage("prefill", prompt_eval_duration / 1e9)
+    eval_count = response.get('eval_count')
+    eval_duration = response.get('eval_duration')
+    if eval_count and eval_duration:
+        GENERATION_TOKENS_PER_SECOND.observe(eval_count / (eval_duration / 1e9))
+
+
+# Structured logging: records are queued here and written as JSON lines by a background thread
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "info").lower()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "200"))
+LOG_IDLE_SECONDS = 30.0
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+LOG_RECORDS_DROPPED = METRICS.register(Counter(
+    "log_records_dropped_total",
+    "Log records dropped because the log queue was full."
+))
+
+class StructuredLogger:
+    """Non-blocking JSON-lines logger.
+
+    ``event()`` costs one ``put_nowait``: formatting, truncation of long string fields
+    and the write to ``stream`` happen on a writer thread. Debug and info records are
+    kept with probability ``sample_rate``; warnings and errors always are. When the
+    queue is full, records are dropped and counted rather than blocking the caller.
+    The writer thread exits after a quiet period and restarts on the next record, so
+    Streamlit reruns don't accumulate threads.
+    """
+    def __init__(
+        self,
+        level: str = LOG_LEVEL,
+        sample_rate: float = LOG_SAMPLE_RATE,
+        queue_size: int = LOG_QUEUE_SIZE,
+        max_field_chars: int = LOG_MAX_FIELD_CHARS,
+        stream=None
+    ):
+        self.level = LOG_LEVELS.get(level, LOG_LEVELS["info"])
+        self.sample_rate = sample_rate
+        self.max_field_chars = max_field_chars
+        self.stream = stream
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def event(self, level: str, event: str, **fields) -> None:
+        severity = LOG_LEVELS[level]
+        if severity < self.level:
+            return
+        if severity < LOG_LEVELS["warning"] and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+            return
+        if self.writer is None:
+            self._start_writer()
+
+    def debug(self, event: str, **fields) -> None:
+        self.event("debug", event, **fields)
+
+    def info(self, event: str, **fields) -> None:
+        self.event("info", event, **fields)
+
+    def warning(self, event: str, **fields) -> None:
+        self.event("warning", event, **fields)
+
+    def error(self, event: str, **fields) -> None:
+        self.event("error", event, **fields)
+
+    def _start_writer(self) -> None:
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, daemon=True)
+                self.writer.start()
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_field_chars:
+            return f"{value[:self.max_field_chars]}...(+{len(value) - self.max_field_chars} chars)"
+        return value
+
+    def format(self, record) -> str:
+        timestamp, level, event, fields = record
+        entry = {
+            "ts": datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds"),
+            "level": level,
+            "event": event
+        }
+        for key, value in fields.items():
+            entry[key] = self._truncate(value)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def _write_loop(self) -> None:
+        while True:
+            try:
+                record = self.queue.get(timeout=LOG_IDLE_SECONDS)
+            except queue.Empty:
+                with self.lock:
+                    if not self.queue.empty():
+                        continue
+                    self.writer = None
+                # A record queued just now may have seen this thread as still running
+                if not self.queue.empty():
+                    self._start_writer()
+                return
+            # Drain whatever else is queued so one flush covers the batch
+            lines = [self.format(record)]
+            while len(lines) < 512:
+                try:
+                    lines.append(self.format(self.queue.get_nowait()))
+                except queue.Empty:
+                    break
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            except Exception:
+                pass
+
+    def flush(self, timeout: float = 2.0) -> None:
+        """Wait briefly for queued records to be written (used at exit)."""
+        deadline = time.monotonic() + timeout
+        while not self.queue.empty() and self.writer is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+log = StructuredLogger()
+atexit.register(log.flush)
+
+METRICS.register(Gauge(
+    "log_queue_depth",
+    "Log records waiting for the writer thread.",
+    lambda: log.queue.qsize()
+))
+
+# Concurrency configuration for the API mode
+MAX_IN_FLIGHT = int(os.environ.get("CHAT_MAX_IN_FLIGHT", "4"))
+MAX_QUEUE = int(os.environ.get("CHAT_MAX_QUEUE", "32"))
+QUEUE_TIMEOUT = float(os.environ.get("CHAT_QUEUE_TIMEOUT", "30"))
+RETRY_AFTER = int(os.environ.get("CHAT_RETRY_AFTER", "5"))
+
+class QueueFullError(Exception):
+    pass
+
+# Priority lanes: messages that look like a crisis skip ahead of routine chat
+PRIORITY_CRISIS = "crisis"
+PRIORITY_ROUTINE = "routine"
+PRIORITIES = (PRIORITY_CRISIS, PRIORITY_ROUTINE)
+CRISIS_RESERVED_SLOTS = int(os.environ.get("CHAT_CRISIS_RESERVED", "1"))
+CRISIS_PRIORITY = os.environ.get("CHAT_CRISIS_PRIORITY", "1") == "1"
+
+# Regex fragments matched as whole words, case-insensitively, with any whitespace between words
+CRISIS_TERMS = (
+    r"suicid(?:e|al)", r"kill(?:ing)? myself", r"end(?:ing)? (?:my|it) (?:life|all)",
+    r"take my (?:own )?life", r"(?:want|wanna|going) to die", r"wanna die",
+    r"better off dead", r"no reason to live", r"not worth living",
+    r"can[\u2019']?t go on", r"self[- ]?harm(?:ing)?", r"hurt(?:ing)? myself",
+    r"cut(?:ting)? myself", r"hang(?:ing)? myself", r"overdos(?:e|ing)",
+    r"khudkushi", r"aatmahatya", r"marna chaht[aie]",
+)
+
+def build_crisis_pattern(terms=CRISIS_TERMS, extra: str = ""):
+    """Compile the crisis terms (plus comma-separated literal ``extra`` phrases) into one regex."""
+    fragments = list(terms) + [re.escape(phrase.strip()) for phrase in extra.split(",") if phrase.strip()]
+    fragments = [re.sub(r"(?:\\ | )+", r"\\s+", fragment) for fragment in fragments]
+    return re.compile(r"\b(?:" + "|".join(fragments) + r")\b", re.IGNORECASE)
+
+CRISIS_PATTERN = build_crisis_pattern(extra=os.environ.get("CRISIS_KEYWORDS", ""))
+
+def is_crisis_message(message: str) -> bool:
+    return CRISIS_PATTERN.search(message or "") is not None
+
+def classify_priority(message: str) -> str:
+    """Scheduling class of a chat message."""
+    if CRISIS_PRIORITY and is_crisis_message(message):
+        return PRIORITY_CRISIS
+    return PRIORITY_ROUTINE
+
+QUEUE_WAIT_SECONDS = METRICS.register(Histogram(
+    "chat_queue_wait_seconds",
+    "Time spent waiting for a generation slot, by priority class (crisis, routine).",
+    labelnames=("priority",)
+))
+PRIORITY_REQUESTS_TOTAL = METRICS.register(Counter(
+    "chat_priority_requests_total",
+    "Generations started, by priority class.",
+    labelnames=("priority",)
+))
+
+class RequestLimiter:
+    """Bound in-flight generations and queue the rest in two priority lanes.
+
+    Crisis requests are served before routine ones and may use ``reserved`` slots that
+    routine traffic never takes. Waiting routine requests are served round-robin by
+    session, so one busy conversation can't hold up everyone else.
+    """
+    def __init__(
+        self,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_queue: int = MAX_QUEUE,
+        queue_timeout: float = QUEUE_TIMEOUT,
+        reserved: int = CRISIS_RESERVED_SLOTS
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # Routine traffic always keeps at least one slot
+        self.reserved = max(0, min(reserved, max_in_flight - 1))
+        self.in_flight = 0
+        self.in_flight_by = {priority: 0 for priority in PRIORITIES}
+        self.waiting_by = {priority: 0 for priority in PRIORITIES}
+        self.crisis_waiters = deque()
+        # session key -> waiters of that session, in the order sessions get their turn
+        self.routine_waiters = OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        return sum(self.waiting_by.values())
+
+    def _limit(self, priority: str) -> int:
+        return self.max_in_flight if priority == PRIORITY_CRISIS else self.max_in_flight - self.reserved
+
+    def _queued(self, priority: str) -> bool:
+        return bool(self.crisis_waiters) or (priority == PRIORITY_ROUTINE and bool(self.routine_waiters))
+
+    def _take(self, priority: str) -> None:
+        self.in_flight += 1
+        self.in_flight_by[priority] += 1
+
+    def _next_routine(self):
+        session_key, waiters = next(iter(self.routine_waiters.items()))
+        future = waiters.popleft()
+        # The session goes to the back of the rotation (or leaves it)
+        del self.routine_waiters[session_key]
+        if waiters:
+            self.routine_waiters[session_key] = waiters
+        return future
+
+    def _dispatch(self) -> None:
+        """Hand free slots to waiters: crisis first, then routine up to the unreserved slots."""
+        while self.crisis_waiters and self.in_flight < self._limit(PRIORITY_CRISIS):
+            future = self.crisis_waiters.popleft()
+            if not future.done():
+                self._take(PRIORITY_CRISIS)
+                future.set_result(None)
+        while self.routine_waiters and self.in_flight < self._limit(PRIORITY_ROUTINE):
+            future = self._next_routine()
+            if not future.done():
+                self._take(PRIORITY_ROUTINE)
+                future.set_result(None)
+
+    def _release(self, priority: str) -> None:
+        self.in_flight -= 1
+        self.in_flight_by[priority] -= 1
+        self._dispatch()
+
+    def _discard(self, priority: str, session_key, future) -> None:
+        if priority == PRIORITY_CRISIS:
+            if future in self.crisis_waiters:
+                self.crisis_waiters.remove(future)
+            return
+        waiters = self.routine_waiters.get(session_key)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self.routine_waiters[session_key]
+
+    @asynccontextmanager
+    async def slot(self, priority: str = PRIORITY_ROUTINE, session_key: Optional[str] = None):
+        """Hold a generation slot, waiting in the lane for ``priority`` if none is free."""
+        started = time.perf_counter()
+        if self.in_flight < self._limit(priority) and not self._queued(priority):
+            self._take(priority)
+        else:
+            if self.waiting_by[priority] >= self.max_queue:
+                raise QueueFullError("Too many requests waiting, please retry later")
+            future = asyncio.get_running_loop().create_future()
+            if priority == PRIORITY_CRISIS:
+                self.crisis_waiters.append(future)
+            else:
+                if session_key is None:
+                    session_key = id(future)
+                self.routine_waiters.setdefault(session_key, deque()).append(future)
+            self.waiting_by[priority] += 1
+            try:
+                await asyncio.wait_for(future, timeout=self.queue_timeout)
+            except BaseException as e:
+                self._discard(priority, session_key, future)
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just as the wait ended
+                    self._release(priority)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise QueueFullError("Timed out waiting for a free generation slot")
+                raise
+            finally:
+                self.waiting_by[priority] -= 1
+        waited = time.perf_counter() - started
+        record_stage("queue_wait", waited)
+        QUEUE_WAIT_SECONDS.observe(waited, priority)
+        PRIORITY_REQUESTS_TOTAL.inc(priority)
+
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "reserved_for_crisis": self.reserved,
+            "in_flight": dict(self.in_flight_by),
+            "waiting": dict(self.waiting_by),
+        }
+
+request_limiter = None
+startup_task = None
+health_task = None
+
+METRICS.register(Gauge(
+    "chat_requests_in_flight",
+    "Generations currently holding a slot.",
+    lambda: request_limiter.in_flight if request_limiter else None
+))
+METRICS.register(Gauge(
+    "chat_requests_waiting",
+    "Requests waiting for a generation slot.",
+    lambda: request_limiter.waiting if request_limiter else None
+))
+METRICS.register(Gauge(
+    "chat_priority_waiting",
+    "Requests waiting for a generation slot, by priority class.",
+    lambda: {(priority,): count for priority, count in request_limiter.waiting_by.items()} if request_limiter else None,
+    labelnames=("priority",)
+))
+
+# Message records: slotted objects instead of one dict per message, with timestamps formatted on demand
+class MessageRecord:
+    """Read-only dict-style access (``msg["content"]``, ``msg.get("tokens")``) over slotted fields."""
+    __slots__ = ()
+    fields = ()
+
+    def __getitem__(self, key: str):
+        if key in self.fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.fields}
+
+class ChatMessage(MessageRecord):
+    """One conversation turn; the API form is built once and shared by every prompt."""
+    __slots__ = ("role", "content", "tokens", "created", "_api")
+    fields = ("role", "content", "timestamp", "tokens")
+
+    def __init__(self, role: str, content: str, tokens: int = 0, created: Optional[float] = None):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+        self.created = time.time() if created is None else created
+        self._api = None
+
+    @property
+    def timestamp(self) -> str:
+        return datetime.fromtimestamp(self.created).isoformat()
+
+    def as_api(self) -> Dict[str, str]:
+        """``{"role", "content"}`` dict for Ollama; callers must not modify it."""
+        if self._api is None:
+            self._api = {"role": self.role, "content": self.content}
+        return self._api
+
+class MessageHistory(deque):
+    """Bounded history of ChatMessages that caches its API view until it changes.
+
+    When full, the oldest turns are evicted in a block down to CONTEXT_LOW_WATER of
+    ``maxlen`` rather than one per append, so the prompt keeps the same prefix (and
+    Ollama's prompt cache stays valid) for the following turns.
+    """
+    __slots__ = ("api_view", "api_view_key", "context_head")
+
+    def __init__(self, iterable=(), maxlen: Optional[int] = None):
+        super().__init__(iterable, maxlen)
+        self.api_view = None
+        self.api_view_key = None
+        # First message sent to the model after the last trim (see ChatClient.select_context)
+        self.context_head = None
+
+    def append(self, message: ChatMessage) -> None:
+        if self.maxlen and len(self) >= self.maxlen:
+            keep = min(self.maxlen - 1, int(self.maxlen * CONTEXT_LOW_WATER))
+            while len(self) > keep:
+                self.popleft()
+        super().append(message)
+        self.api_view = None
+
+    def pop(self) -> ChatMessage:
+        self.api_view = None
+        return super().pop()
+
+    def clear(self) -> None:
+        super().clear()
+        self.api_view = None
+
+# Session configuration for the API mode
+MAX_SESSIONS = int(os.environ.get("CHAT_MAX_SESSIONS", "10000"))
+SESSION_TTL = float(os.environ.get("CHAT_SESSION_TTL", "1800"))
+SESSION_MEMORY_CAP = int(os.environ.get("CHAT_SESSION_MEMORY_CAP", str(64 * 1024 * 1024)))
+
+class SessionState:
+    """Conversation state of one API session; the Ollama client and TTS stay shared."""
+    __slots__ = ("conversation_history", "last_used", "size")
+
+    def __init__(self, max_history: int = 10):
+        self.conversation_history = MessageHistory(maxlen=max_history)
+        self.last_used = time.monotonic()
+        self.size = 0
+
+    def measure(self) -> int:
+        """Approximate the memory held by the session's messages in bytes."""
+        self.size = sum(sys.getsizeof(msg.content) for msg in self.conversation_history)
+        return self.size
+
+class SessionRegistry:
+    """Session-ID keyed conversation state with LRU, idle-TTL and memory-cap eviction."""
+    def __init__(
+        self,
+        max_history: int = 10,
+        max_sessions: int = MAX_SESSIONS,
+        ttl: float = SESSION_TTL,
+        memory_cap: int = SESSION_MEMORY_CAP
+    ):
+        self.max_history = max_history
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.memory_cap = memory_cap
+        self.sessions = OrderedDict()
+        self.total_size = 0
+
+    def get(self, session_id: str) -> SessionState:
+        """Return the state for a session, creating it if needed, and mark it recently used."""
+        self.evict_expired()
+        state = self.sessions.get(session_id)
+        if state is None:
+            state = SessionState(self.max_history)
+            self.sessions[session_id] = state
+        else:
+            self.sessions.move_to_end(session_id)
+        state.last_used = time.monotonic()
+        self._enforce_caps(keep=session_id)
+        return state
+
+    def update(self, session_id: str) -> None:
+        """Re-account a session's memory after its history changed."""
+        state = self.sessions.get(session_id)
+        if state is None:
+            return
+        previous = state.size
+        self.total_size += state.measure() - previous
+        self._enforce_caps(keep=session_id)
+
+    def evict_expired(self) -> None:
+        """Drop sessions idle for longer than the TTL, oldest first."""
+        now = time.monotonic()
+        while self.sessions:
+            session_id, state = next(iter(self.sessions.items()))
+            if now - state.last_used < self.ttl:
+                break
+            self._remove(session_id)
+
+    def _enforce_caps(self, keep: str) -> None:
+        while len(self.sessions) > self.max_sessions or self.total_size > self.memory_cap:
+            session_id = next(iter(self.sessions))
+            if session_id == keep:
+                break
+            self._remove(session_id)
+
+    def _remove(self, session_id: str) -> None:
+        state = self.sessions.pop(session_id)
+        self.total_size -= state.size
+
+session_registry = None
+
+METRICS.register(Gauge(
+    "chat_sessions",
+    "Conversations held in the session registry.",
+    lambda: len(session_registry.sessions) if session_registry else None
+))
+
+# Client disconnects: abandon the reply instead of finishing it for nobody
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("CHAT_DISCONNECT_POLL", "0.25"))
+
+class DisconnectGuard:
+    """Cancel ``task`` as soon as the ``disconnected`` coroutine returns."""
+    def __init__(self, task: "asyncio.Task", disconnected):
+        self.task = task
+        self.tripped = False
+        self.watcher = asyncio.ensure_future(self._watch(disconnected))
+
+    async def _watch(self, disconnected) -> None:
+        try:
+            await disconnected
+        except Exception:
+            # Can't tell whether the client is still there; let the work finish
+            return
+        if not self.task.done():
+            self.tripped = True
+            self.task.cancel()
+
+    def close(self) -> None:
+        self.watcher.cancel()
+
+async def wait_for_disconnect(request: Request) -> None:
+    """Return once the HTTP client has gone away."""
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+async def wait_for_websocket_close(websocket: WebSocket, pending: deque) -> None:
+    """Return once the WebSocket closes, queueing every message received meanwhile (the close too)."""
+    while True:
+        message = await websocket.receive()
+        pending.append(message)
+        if message["type"] == "websocket.disconnect":
+            return
+
+async def reply_audio(response: str) -> Dict[str, Any]:
+    """Synthesize the reply as a file reference or, in inline mode, as base64 WAV bytes."""
+    try:
+        if hasattr(chat_client, 'tts'):
+            if TTS_AUDIO_MODE == "stream":
+                # Synthesis starts when the client opens the URL
+                return {"audio": None, "audio_stream": f"/tts/stream/{audio_streams.issue(response)}"}
+            if TTS_AUDIO_MODE == "inline":
+                audio_bytes = await chat_client.generate_tts_bytes(response)
+                if audio_bytes:
+                    return {
+                        "audio": None,
+                        "audio_data": base64.b64encode(audio_bytes).decode('utf-8'),
+                        "audio_mime": "audio/wav"
+                    }
+            else:
+                audio_file = await chat_client.generate_tts(response)
+                return {"audio": audio_file if audio_file else None}
+    except Exception as tts_error:
+        log.warning("tts.failed", error=str(tts_error))
+        # Continue without audio - this is not a critical error
+    return {"audio": None}
+
+def request_priority(request: ChatRequest, endpoint: str) -> str:
+    priority = classify_priority(request.message)
+    if priority == PRIORITY_CRISIS:
+        log.warning("chat.crisis", endpoint=endpoint, waiting=request_limiter.waiting_by[PRIORITY_CRISIS])
+    return priority
+
+async def chat_reply(request: ChatRequest, session_id: str):
+    """Generate the reply while holding a generation slot, then its audio after releasing it."""
+    session = session_registry.get(session_id)
+    
+    async with request_limiter.slot(request_priority(request, "/chat"), session_id):
+        # Get response from chat client without blocking the event loop
+        response = await chat_client.acreate_chat_completion(
+            request.message,
+            history=session.conversation_history,
+            session_key=session_id
+        )
+    session_registry.update(session_id)
+    log.debug("chat.response", chars=len(response), response=response)
+    
+    # Generate TTS if available; Ollama can take the next request meanwhile
+    audio = await reply_audio(response)
+    return response, audio
+
 @app.post("/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request):
+    trace = RequestTrace()
+    current_trace.set(trace)
+    started = time.perf_counter()
+    guard = None
     try:
-        print(f"Received chat request: {request.message}")
+        log.info("chat.request", endpoint="/chat", chars=len(request.message))
+        log.debug("chat.message", endpoint="/chat", message=request.message)
         
-        # Get response from chat client
-        response = chat_client.create_chat_completion(request.message)
-        print(f"Generated response: {response}")
+        session_id = request.session_id or uuid.uuid4().hex
         
-        # Generate TTS if available
-        audio_file = None
+        # Stop generating (and synthesizing) if the client gives up before the reply is ready
+        work = asyncio.ensure_future(chat_reply(request, session_id))
+        guard = DisconnectGuard(work, wait_for_disconnect(http_request))
         try:
-            if hasattr(chat_client, 'tts'):
-                audio_file = await chat_client.generate_tts(response)
-                print(f"Generated audio file: {audio_file}")
-        except Exception as tts_error:
-            print(f"TTS generation failed (non-critical): {str(tts_error)}")
-            # Continue without audio - this is not a critical error
+            response, audio = await work
+        except asyncio.CancelledError:
+            if not guard.tripped:
+                raise
+            log.info("chat.cancelled", endpoint="/chat")
+            REQUESTS_TOTAL.inc("/chat", "cancelled")
+            return JSONResponse(status_code=499, content={"error": "Client disconnected"})
         
-        return {
-            "response": response,
-            "audio": audio_file if audio_file else None
-        }
+        trace.record("total", time.perf_counter() - started)
+        REQUESTS_TOTAL.inc("/chat", "ok")
+        return JSONResponse(
+            content={
+                "response": response,
+                **audio,
+                "session_id": session_id
+            },
+            headers={"Server-Timing": trace.server_timing()}
+        )
+    except QueueFullError as e:
+        log.warning("chat.rejected", endpoint="/chat", reason=str(e))
+        REQUESTS_TOTAL.inc("/chat", "rejected")
+        return JSONResponse(
+            status_code=503,
+            content={"error": str(e)},
+            headers={"Retry-After": str(RETRY_AFTER)}
+        )
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
-        return {"error": str(e)}, 500
+        log.error("chat.error", endpoint="/chat", error=str(e))
+        REQUESTS_TOTAL.inc("/chat", "error")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    finally:
+        if guard:
+            guard.close()
+
+async def stream_chat_events(
+    message: str,
+    session_id: str,
+    trace: Optional[RequestTrace] = None,
+    with_audio: bool = True,
+    release=None
+):
+    """Yield token events as Ollama produces them, then one final "done" event.
+
+    ``release`` is awaited once generation has finished, before any TTS, so the caller's
+    generation slot isn't held while Piper runs.
+    """
+    trace = trace or RequestTrace()
+    current_trace.set(trace)
+    started = time.perf_counter()
+    session = session_registry.get(session_id)
+    response = ""
+    mood = "happy"
+    kaomoji = None
+    async for event in chat_client.acreate_streaming_chat_completion(
+        message,
+        history=session.conversation_history,
+        session_key=session_id
+    ):
+        if event["type"] == "token":
+            yield event
+        else:
+            response, mood, kaomoji = event["response"], event["mood"], event["kaomoji"]
+    session_registry.update(session_id)
+    if release is not None:
+        await release()
+    
+    # Generate TTS if available
+    audio = await reply_audio(response) if with_audio else {"audio": None}
+    trace.record("total", time.perf_counter() - started)
+    
+    yield {
+        "type": "done",
+        "response": response,
+        "mood": mood,
+        "kaomoji": kaomoji,
+        **audio,
+        "session_id": session_id,
+        "timings": trace.as_millis()
+    }
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, http_request: Request):
+    """Stream the reply as server-sent events."""
+    log.info("chat.request", endpoint="/chat/stream", chars=len(request.message))
+    log.debug("chat.message", endpoint="/chat/stream", message=request.message)
+    session_id = request.session_id or uuid.uuid4().hex
+    trace = RequestTrace()
+    current_trace.set(trace)
+    
+    # Take the generation slot before the response starts so a full queue is still a 503
+    stack = AsyncExitStack()
+    try:
+        await stack.enter_async_context(
+            request_limiter.slot(request_priority(request, "/chat/stream"), session_id)
+        )
+    except QueueFullError as e:
+        log.warning("chat.rejected", endpoint="/chat/stream", reason=str(e))
+        REQUESTS_TOTAL.inc("/chat/stream", "rejected")
+        return JSONResponse(
+            status_code=503,
+            content={"error": str(e)},
+            headers={"Retry-After": str(RETRY_AFTER)}
+        )
+    
+    async def produce(events: asyncio.Queue):
+        try:
+            async for event in stream_chat_events(request.message, session_id, trace, release=stack.aclose):
+                events.put_nowait(event)
+        finally:
+            events.put_nowait(None)
+    
+    async def event_source():
+        async with stack:
+            # Generation runs in its own task so a disconnect can cancel it even between tokens
+            events = asyncio.Queue()
+            work = asyncio.ensure_future(produce(events))
+            guard = DisconnectGuard(work, wait_for_disconnect(http_request))
+            try:
+                while (event := await events.get()) is not None:
+                    yield f"data: {json.dumps(event)}\n\n"
+                await work
+                REQUESTS_TOTAL.inc("/chat/stream", "ok")
+            except asyncio.CancelledError:
+                # Cancelled by the guard, or by the server noticing the disconnect first
+                log.info("chat.cancelled", endpoint="/chat/stream")
+                REQUESTS_TOTAL.inc("/chat/stream", "cancelled")
+                if not guard.tripped:
+                    work.cancel()
+                    raise
+            except Exception as e:
+                log.error("chat.error", endpoint="/chat/stream", error=str(e))
+                REQUESTS_TOTAL.inc("/chat/stream", "error")
+                yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+            finally:
+                guard.close()
+                if not work.done():
+                    # The response was closed early (e.g. a failed write)
+                    work.cancel()
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """Stream replies over a WebSocket; each client message is a JSON ChatRequest."""
+    await websocket.accept()
+    # Messages that arrive while a reply is streaming are answered afterwards
+    pending = deque()
+    
+    async def relay(request: ChatRequest, session_id: str, trace: RequestTrace):
+        response = ""
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(
+                request_limiter.slot(request_priority(request, "/chat/ws"), session_id)
+            )
+            async for event in stream_chat_events(
+                request.message, session_id, trace, with_audio=not request.stream_audio, release=stack.aclose
+            ):
+                await websocket.send_json(event)
+                if event["type"] == "done":
+                    response = event["response"]
+        
+        # Sends are paced by the client, so audio streams under its own bound, not a generation slot
+        if request.stream_audio:
+            if response and shutil.which("ffmpeg") is None:
+                await websocket.send_json({"type": "error", "error": OPUS_UNAVAILABLE})
+            elif response:
+                try:
+                    async with audio_stream_slots.slot():
+                        async for chunk in chat_client.tts.stream_opus(response):
+                            await websocket.send_bytes(chunk)
+                except QueueFullError as e:
+                    await websocket.send_json({"type": "error", "error": str(e), "retry_after": RETRY_AFTER})
+            await websocket.send_json({"type": "audio_end"})
+    
+    try:
+        while True:
+            message = pending.popleft() if pending else await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                payload = json.loads(message.get("text") or message.get("bytes") or "")
+                request = ChatRequest(**payload)
+            except (ValueError, TypeError) as e:
+                # Bad JSON or a body that isn't a ChatRequest; the connection stays open
+                REQUESTS_TOTAL.inc("/chat/ws", "invalid")
+                await websocket.send_json({"type": "error", "error": f"Invalid request: {e}"})
+                continue
+            session_id = request.session_id or uuid.uuid4().hex
+            trace = RequestTrace()
+            current_trace.set(trace)
+            work = asyncio.ensure_future(relay(request, session_id, trace))
+            guard = DisconnectGuard(work, wait_for_websocket_close(websocket, pending))
+            try:
+                await work
+                REQUESTS_TOTAL.inc("/chat/ws", "ok")
+            except asyncio.CancelledError:
+                if not guard.tripped:
+                    raise
+                log.info("chat.cancelled", endpoint="/chat/ws")
+                REQUESTS_TOTAL.inc("/chat/ws", "cancelled")
+                return
+            except QueueFullError as e:
+                REQUESTS_TOTAL.inc("/chat/ws", "rejected")
+                await websocket.send_json({
+                    "type": "error",
+                    "error": str(e),
+                    "retry_after": RETRY_AFTER
+                })
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                log.error("chat.error", endpoint="/chat/ws", error=str(e))
+                REQUESTS_TOTAL.inc("/chat/ws", "error")
+                await websocket.send_json({"type": "error", "error": str(e)})
+            finally:
+                guard.close()
+    except WebSocketDisconnect:
+        pass
+
+class AudioStreamTokens:
+    """Short-lived tokens that let a client fetch a reply's audio stream by URL.
+
+    Each token can be fetched ``max_fetches`` times (a browser may re-request a media URL
+    once), so a leaked URL can't be used to keep starting synthesis.
+    """
+    def __init__(self, ttl: float = 300.0, max_entries: int = 10000, max_fetches: int = 2):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_fetches = max_fetches
+        self.texts = OrderedDict()
+
+    def issue(self, text: str) -> str:
+        now = time.monotonic()
+        while self.texts and (
+            len(self.texts) >= self.max_entries or next(iter(self.texts.values()))[1] < now
+        ):
+            self.texts.popitem(last=False)
+        token = uuid.uuid4().hex
+        self.texts[token] = [text, now + self.ttl, self.max_fetches]
+        return token
+
+    def take(self, token: str) -> Optional[str]:
+        """Return the text for ``token`` and count the fetch; None once expired or used up."""
+        entry = self.texts.get(token)
+        if entry is None:
+            return None
+        expired = entry[1] < time.monotonic()
+        entry[2] -= 1
+        if expired or entry[2] <= 0:
+            del self.texts[token]
+        return None if expired else entry[0]
+
+audio_streams = AudioStreamTokens()
+
+# Ogg/Opus streams encoded at once, across /tts/stream and /chat/ws
+AUDIO_STREAM_MAX = int(os.environ.get("AUDIO_STREAM_MAX", "8"))
+
+class AudioStreamSlots:
+    """Bound the Opus streams running at once; each holds an ffmpeg process and Piper jobs."""
+    def __init__(self, limit: int = AUDIO_STREAM_MAX):
+        self.limit = limit
+        self.active = 0
+
+    def full(self) -> bool:
+        return self.active >= self.limit
+
+    def acquire(self) -> None:
+        if self.full():
+            raise QueueFullError("Too many audio streams, please retry later")
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+audio_stream_slots = AudioStreamSlots()
+
+METRICS.register(Gauge(
+    "audio_streams_active",
+    "Ogg/Opus audio streams currently being encoded.",
+    lambda: audio_stream_slots.active
+))
+
+OPUS_UNAVAILABLE = "Audio streaming needs ffmpeg on PATH"
+
+async def bounded_opus_stream(text: str):
+    """Opus pages for ``text`` while holding an audio stream slot.
+
+    The slot is taken here, not before the response is created, so a client that leaves
+    before the body starts doesn't leak it.
+    """
+    try:
+        async with audio_stream_slots.slot():
+            async for chunk in chat_client.tts.stream_opus(text):
+                yield chunk
+    except QueueFullError:
+        # Filled up between the check in opus_stream_response and the first read
+        return
+
+def opus_stream_response(text: str):
+    if shutil.which("ffmpeg") is None:
+        return JSONResponse(status_code=503, content={"error": OPUS_UNAVAILABLE})
+    if audio_stream_slots.full():
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Too many audio streams, please retry later"},
+            headers={"Retry-After": str(RETRY_AFTER)}
+        )
+    return StreamingResponse(
+        bounded_opus_stream(text),
+        media_type="audio/ogg",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/tts/stream/{token}")
+async def tts_stream_token_endpoint(token: str):
+    """Stream the audio of a reply returned with TTS_AUDIO_MODE=stream."""
+    text = audio_streams.take(token)
+    if text is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired audio stream"})
+    return opus_stream_response(text)
+
+@app.get("/healthz")
+async def healthz_endpoint():
+    """Liveness: the process is up and serving requests."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz_endpoint():
+    """Readiness: the model is available (and warmed up when OLLAMA_WARMUP is set)."""
+    global startup_task
+    if not chat_client.ready and (startup_task is None or startup_task.done()):
+        # Retry the check in the background; the probe itself never waits on Ollama
+        startup_task = asyncio.create_task(chat_client.prepare())
+    if chat_client.ready:
+        return {"status": "ready", "model": chat_client.model}
+    return JSONResponse(
+        status_code=503,
+        content={
+            "status": "starting" if chat_client.readiness_error is None else "unavailable",
+            "model": chat_client.model,
+            "error": chat_client.readiness_error
+        }
+    )
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text-format metrics."""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats_endpoint():
+    """Prompt prefix-cache effectiveness, TTS and response cache counters, Ollama backend load and scheduler lanes."""
+    return {
+        "scheduler": request_limiter.snapshot(),
+        "prompt_cache": chat_client.prompt_cache.snapshot(),
+        "tts_cache": chat_client.tts.cache.stats() if chat_client.tts.cache else None,
+        "response_cache": chat_client.response_cache.stats() if chat_client.response_cache else None,
+        "ollama_backends": chat_client.backends.snapshot()
+    }
 
 # Model configuration
 
@@ -272,6 +1411,102 @@ KAOMOJI = {
 }
 
 
+# Mood keywords, in priority order: the first mood with any keyword in the text wins
+MOOD_KEYWORDS = {
+    "happy": ["happy", "joy", "excited", "wonderful", "great", "yay", "nice", "よかった", "うれしい"],
+    "sad": ["sad", "sorry", "unfortunate", "regret", "apologize", "ごめん", "すみません"],
+    "surprised": ["wow", "oh", "amazing", "incredible", "unexpected", "すごい", "えっ"],
+    "love": ["love", "adore", "appreciate", "care", "好き", "大好き"],
+    "thinking": ["think", "consider", "maybe", "perhaps", "possibly", "そうですね"],
+    "excited": ["fantastic", "awesome", "excellent", "brilliant", "わくわく"],
+    "apologetic": ["sorry", "apologize", "regret", "mistake", "申し訳ない"],
+    "playful": ["hehe", "fun", "play", "joke", "うふふ", "えへへ"],
+    "sleepy": ["tired", "sleep", "rest", "yawn", "眠い", "疲れた"],
+    "determined": ["will", "must", "definitely", "certainly", "頑張る", "できる"]
+}
+
+class MoodMatcher:
+    """Aho-Corasick automaton over a keyword table, built once.
+
+    Each state carries a bitmask of the moods whose keywords end there, so one
+    linear pass over the text finds every mood present.
+    """
+    def __init__(self, keywords: Dict[str, List[str]], default: str = "happy"):
+        self.moods = list(keywords)
+        self.default = default
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [0]
+
+        for index, mood in enumerate(self.moods):
+            for keyword in keywords[mood]:
+                node = 0
+                for char in keyword.lower():
+                    next_node = self.goto[node].get(char)
+                    if next_node is None:
+                        next_node = len(self.goto)
+                        self.goto[node][char] = next_node
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.output.append(0)
+                    node = next_node
+                self.output[node] |= 1 << index
+
+        # Breadth-first fail links; outputs inherit from their fail state
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] |= self.output[self.fail[child]]
+                pending.append(child)
+
+    def scan(self, node: int, text: str) -> tuple:
+        """Advance from node over lower-cased text; return (node, mask of moods matched)."""
+        goto, fail, output = self.goto, self.fail, self.output
+        seen = 0
+        for char in text.lower():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            seen |= output[node]
+        return node, seen
+
+    def mood_for(self, seen: int) -> str:
+        if not seen:
+            return self.default
+        return self.moods[(seen & -seen).bit_length() - 1]
+
+    def detect(self, text: str) -> str:
+        return self.mood_for(self.scan(0, text)[1])
+
+    def scanner(self) -> "MoodScanner":
+        return MoodScanner(self)
+
+class MoodScanner:
+    """Incremental mood detection over a streamed response; state carries across chunks."""
+    __slots__ = ("matcher", "node", "seen")
+
+    def __init__(self, matcher: MoodMatcher):
+        self.matcher = matcher
+        self.node = 0
+        self.seen = 0
+
+    def feed(self, chunk: str) -> str:
+        self.node, seen = self.matcher.scan(self.node, chunk)
+        self.seen |= seen
+        return self.mood
+
+    @property
+    def mood(self) -> str:
+        return self.matcher.mood_for(self.seen)
+
+MOOD_MATCHER = MoodMatcher(MOOD_KEYWORDS)
+
+
 # Theme configurations
 THEMES = {
     "Default": {
@@ -300,89 +1535,747 @@ THEMES = {
     }
 }
 
+# Piper TTS configuration
+PIPER_BINARY = os.environ.get("PIPER_BINARY", str(Path("piper/piper.exe")))
+PIPER_MODEL = os.environ.get("PIPER_MODEL", str(Path("piper/en_US-hfc_female-medium.onnx")))
+PIPER_CONFIG = os.environ.get("PIPER_CONFIG", str(Path("piper/en_US-hfc_female-medium.onnx.json")))
+PIPER_WORKERS = int(os.environ.get("PIPER_WORKERS", "2"))
+PIPER_TIMEOUT = float(os.environ.get("PIPER_TIMEOUT", "60"))
+PIPER_HEALTH_INTERVAL = float(os.environ.get("PIPER_HEALTH_INTERVAL", "10"))
+# After a failed start, TTS is skipped for this long before Piper is looked for again
+PIPER_RETRY_INTERVAL = float(os.environ.get("PIPER_RETRY_INTERVAL", "60"))
+
+class PiperWorker:
+    """A resident `piper --json-input` process that keeps the voice model loaded."""
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        self.process = subprocess.Popen(
+            [
+                PIPER_BINARY,
+                '--model', PIPER_MODEL,
+                '--config', PIPER_CONFIG,
+                '--json-input'
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding='utf-8',
+            bufsize=1
+        )
+
+    def stop(self) -> None:
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def restart(self) -> None:
+        print(f"Restarting Piper worker {self.index}")
+        self.stop()
+        self.start()
+        self.restarts += 1
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def synthesize(self, text: str, output_file: str) -> str:
+        """Synthesize one utterance to output_file; the caller must hold the lock."""
+        if not self.is_alive():
+            self.restart()
+
+        # A hung worker is killed, which unblocks readline below
+        watchdog = threading.Timer(PIPER_TIMEOUT, self.process.kill)
+        watchdog.start()
+        try:
+            self.process.stdin.write(json.dumps({"text": text, "output_file": output_file}) + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (BrokenPipeError, OSError) as e:
+            self.stop()
+            raise RuntimeError(f"Piper worker {self.index} failed: {e}")
+        finally:
+            watchdog.cancel()
+
+        if not line:
+            self.stop()
+            raise RuntimeError(f"Piper worker {self.index} exited during synthesis")
+        return line.strip()
+
+class SynthesisCancelled(Exception):
+    pass
+
+class SynthesisFailed(Exception):
+    pass
+
+class PiperWorkerPool:
+    """Spread synthesis across resident Piper workers and restart the ones that crash."""
+    def __init__(self, size: int = PIPER_WORKERS):
+        self.workers = [PiperWorker(i) for i in range(max(1, size))]
+        self.idle = queue.Queue()
+        self.closed = threading.Event()
+        self.monitor = None
+
+    def start(self) -> None:
+        for worker in self.workers:
+            worker.start()
+            self.idle.put(worker)
+        self.monitor = threading.Thread(target=self._health_check_loop, daemon=True)
+        self.monitor.start()
+        atexit.register(self.close)
+
+    def synthesize(self, text: str, output_file: str, cancelled: Optional[threading.Event] = None) -> str:
+        """Run one utterance on the next idle worker (blocking).
+
+        Once ``cancelled`` is set, a job that has not started is skipped and the output of
+        a running one is deleted. Running jobs are not killed: restarting the worker would
+        cost a voice model reload.
+        """
+        worker = self.idle.get()
+        try:
+            if cancelled is not None and cancelled.is_set():
+                raise SynthesisCancelled("Synthesis abandoned before it started")
+            with worker.lock:
+                path = worker.synthesize(text, output_file)
+            if cancelled is not None and cancelled.is_set():
+                Path(output_file).unlink(missing_ok=True)
+                raise SynthesisCancelled("Synthesis abandoned, output discarded")
+            return path
+        finally:
+            self.idle.put(worker)
+
+    def _health_check_loop(self) -> None:
+        while not self.closed.wait(PIPER_HEALTH_INTERVAL):
+            for worker in self.workers:
+                # Busy workers are checked on their next request instead
+                if not worker.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if not worker.is_alive():
+                        worker.restart()
+                except Exception as e:
+                    print(f"Piper worker {worker.index} restart failed: {e}")
+                finally:
+                    worker.lock.release()
+
+    def close(self) -> None:
+        self.closed.set()
+        for worker in self.workers:
+            # Don't hang at shutdown behind a stuck synthesis
+            acquired = worker.lock.acquire(timeout=1)
+            try:
+                worker.stop()
+            finally:
+                if acquired:
+                    worker.lock.release()
+
+# TTS cache configuration (a size of 0 disables the cache)
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", str(Path("static/tts_cache")))
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+class TTSCache:
+    """Content-addressed store of synthesized audio with LRU eviction by total bytes."""
+    def __init__(self, cache_dir: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._load_index()
+
+    def _load_index(self) -> None:
+        """Rebuild the index from disk, oldest files first, and drop leftover partial files."""
+        entries = []
+        for path in self.cache_dir.glob("*.wav"):
+            if path.name.endswith(".part.wav"):
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    @staticmethod
+    def key(text: str, voice: str) -> str:
+        """Hash of the normalized text plus the voice/model/config identity."""
+        payload = json.dumps([TTSCache.normalize(text), voice], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.wav"
+
+    def temp_path_for(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.{uuid.uuid4().hex}.part.wav"
+
+    def get(self, key: str) -> Optional[Path]:
+        with self.lock:
+            if key in self.index:
+                path = self.path_for(key)
+                if path.exists():
+                    self.index.move_to_end(key)
+                    self.hits += 1
+                    return path
+                self.total_bytes -= self.index.pop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key: str, source: Path) -> Path:
+        """Move a freshly synthesized file into the store under its key."""
+        path = self.path_for(key)
+        os.replace(source, path)
+        size = path.stat().st_size
+        with self.lock:
+            self.total_bytes += size - self.index.pop(key, 0)
+            self.index[key] = size
+            self._evict()
+        return path
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            self.path_for(key).unlink(missing_ok=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.index),
+            "bytes": self.total_bytes
+        }
+
+# Audio file lifecycle: "file" writes WAVs under static/output, "inline" returns the bytes instead,
+# "stream" returns a /tts/stream URL that plays Ogg/Opus while the reply is still being synthesized
+TTS_AUDIO_MODE = os.environ.get("TTS_AUDIO_MODE", "file")
+AUDIO_MAX_AGE = float(os.environ.get("AUDIO_MAX_AGE", "3600"))
+AUDIO_MAX_BYTES = int(os.environ.get("AUDIO_MAX_BYTES", str(512 * 1024 * 1024)))
+AUDIO_REAP_INTERVAL = float(os.environ.get("AUDIO_REAP_INTERVAL", "60"))
+
+class AudioFileReaper:
+    """Background thread that deletes output audio by age and keeps the directory under a size limit."""
+    def __init__(
+        self,
+        directory: Path,
+        max_age: float = AUDIO_MAX_AGE,
+        max_bytes: int = AUDIO_MAX_BYTES,
+        interval: float = AUDIO_REAP_INTERVAL
+    ):
+        self.directory = Path(directory)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Error reaping audio files: {e}")
+
+    def reap(self) -> int:
+        """Delete expired files, then the oldest ones until the total size fits; return the count."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".wav"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+
+        now = time.time()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+# Synthesis works sentence by sentence; short fragments are merged with a neighbour
+SENTENCE_END = re.compile(r"(?<=[.!?\u2026])\s+|\n+")
+SENTENCE_MIN_CHARS = 20
+# Sentences synthesized concurrently (one per Piper worker) and the pause put between them
+TTS_PARALLEL = os.environ.get("TTS_PARALLEL", "1") == "1"
+TTS_SENTENCE_SILENCE = float(os.environ.get("TTS_SENTENCE_SILENCE", "0.25"))
+
+def split_sentences(text: str, min_chars: int = SENTENCE_MIN_CHARS) -> List[str]:
+    """Split text at sentence ends and line breaks, joining fragments shorter than min_chars."""
+    sentences = []
+    for part in SENTENCE_END.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        if sentences and (len(part) < min_chars or len(sentences[-1]) < min_chars):
+            sentences[-1] = f"{sentences[-1]} {part}"
+        else:
+            sentences.append(part)
+    return sentences
+
 class PiperTTS:
     def __init__(self):
-        self.process = None
+        self.pool = None
         self.initialized = False
+        # Streamlit sessions share one PiperTTS and initialize it from their own threads
+        self.init_lock = threading.Lock()
+        self.retry_at = 0.0
         self.output_dir = Path('static/output')
         self.output_dir.mkdir(parents=True,exist_ok=True)
+        self.cache = TTSCache() if TTS_CACHE_MAX_BYTES > 0 else None
+        self.voice_id = self._voice_identity()
+        self.reaper = None
+        if TTS_AUDIO_MODE == "file":
+            self.reaper = AudioFileReaper(self.output_dir)
+            self.reaper.start()
         print(f"Initialized PiperTTS with output directory: {self.output_dir.absolute()}")
 
+    @staticmethod
+    def _voice_identity() -> str:
+        """Identify the voice so cached audio is invalidated when the model or config changes."""
+        parts = [PIPER_MODEL, PIPER_CONFIG]
+        for path in (PIPER_MODEL, PIPER_CONFIG):
+            try:
+                stat = os.stat(path)
+                parts.append(f"{stat.st_size}:{int(stat.st_mtime)}")
+            except OSError:
+                parts.append("missing")
+        return "|".join(parts)
+
+    @staticmethod
+    def _public_path(path: Path) -> str:
+        """Path of a file relative to the static directory, as returned to clients."""
+        try:
+            path = Path(path).relative_to("static")
+        except ValueError:
+            pass
+        return str(path).replace("\\", "/")
+
     async def initialize(self):
-        if not self.initialized:
+        if self.initialized:
+            return True
+        # A failed start is remembered, so synthesis calls don't re-check the disk every time
+        if time.monotonic() < self.retry_at:
+            return False
+        with self.init_lock:
+            if self.initialized:
+                return True
+            if time.monotonic() < self.retry_at:
+                return False
             try:
-                piper_path = Path('piper/piper.exe')
+                piper_path = Path(PIPER_BINARY)
                 if not piper_path.exists():
-                    print(f"Warning: Piper executable not found at {piper_path}")
-                    return False
+                    raise FileNotFoundError(f"Piper executable not found at {piper_path}")
                     
-                self.process = subprocess.Popen(
-                    [
-                        str(piper_path),
-                        '-m', 'piper/en_US-hfc_female-medium.onnx',
-                        '-c', 'piper/en_en_US_hfc_female_medium_en_US-hfc_female-medium.onnx.json',
-                        '--json-input'
-                    ],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
+                self.pool = PiperWorkerPool()
+                self.pool.start()
                 self.initialized = True
-                print('Piper initialized successfully')
+                print(f'Piper initialized successfully with {len(self.pool.workers)} workers')
                 return True
             except Exception as e:
-                print('Piper initialization failed:', e)
+                self.retry_at = time.monotonic() + PIPER_RETRY_INTERVAL
+                log.warning("tts.unavailable", reason=str(e), retry_in=PIPER_RETRY_INTERVAL)
                 return False
 
-    async def generate_speech(self, text: str):
-        # Line A: Ensure PiperTTS is initialized.
+    def _new_output_file(self) -> str:
+        """Collision-free output filename, still sortable by creation time."""
+        return str(self.output_dir / f'output_{int(time.time() * 1000)}_{uuid.uuid4().hex[:12]}.wav')
+
+    async def _synthesize(self, text: str, output_file: Optional[str], sentence: bool = False) -> Optional[Path]:
+        """Synthesize text and return the WAV path (a cache entry when the cache is enabled).
+
+        With ``sentence``, the time is observed as ``tts_sentence`` in the histogram only:
+        sentences run concurrently, so adding them to the request's trace would overstate it.
+        """
+        # Serve repeated phrases straight from the cache.
+        cache_key = None
+        if self.cache:
+            cache_key = TTSCache.key(text, self.voice_id)
+            cached = self.cache.get(cache_key)
+            if cached:
+                TTS_REQUESTS_TOTAL.inc("hit")
+                return cached
+            TTS_REQUESTS_TOTAL.inc("miss")
+        else:
+            TTS_REQUESTS_TOTAL.inc("disabled")
+
+        # Ensure PiperTTS is initialized.
         if not self.initialized:
             success = await self.initialize()
             if not success:
-                print("Skipping TTS generation - Piper not available")
                 return None
 
         try:
-            # Line B: Create a unique output filename.
-            output_file = str(self.output_dir / f'output_{int(time.time() * 1000)}.wav')
-            
-            # Line C: Build the command string using the working shell command.
-            # This command pipes the text to piper.exe with the required model, config, and output file.
-            command = (
-                f'echo "{text}" | {str(Path("piper/piper.exe"))} '
-                f'--model {str(Path("piper/en_US-hfc_female-medium.onnx"))} '
-                f'--config {str(Path("piper/en_US-hfc_female-medium.onnx.json"))} '
-                f'--output-file {output_file}'
-            )
-            
-            # Line D: Execute the command asynchronously in a subprocess shell.
-            process = await asyncio.create_subprocess_shell(
-                command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            # Line E: Wait for the process to complete and capture its output.
-            stdout, stderr = await process.communicate()
+            if cache_key:
+                text = TTSCache.normalize(text)
+                output_file = str(self.cache.temp_path_for(cache_key))
             
-            # Line F: Check if the process executed successfully.
-            if process.returncode != 0:
-                print("Error generating speech:", stderr.decode())
-                return None
+            # Hand the utterance to a resident worker; the voice model is already loaded.
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            cancelled = threading.Event()
+            try:
+                await loop.run_in_executor(None, self.pool.synthesize, text, output_file, cancelled)
+            except asyncio.CancelledError:
+                # The executor thread can't be interrupted; tell it to drop the job instead
+                cancelled.set()
+                CANCELLED_TOTAL.inc("tts_synthesis")
+                raise
+            if sentence:
+                STAGE_SECONDS.observe(time.perf_counter() - started, "tts_sentence")
             else:
-                print("Generated audio file:", output_file)
-                rel_path = Path(output_file).relative_to("static")
-                return str(rel_path).replace("\\", "/") 
+                record_stage("tts_synthesis", time.perf_counter() - started)
+            
+            if cache_key:
+                return self.cache.put(cache_key, Path(output_file))
+            return Path(output_file)
         except Exception as e:
-            print("Piper error:", e)
+            log.error("tts.error", error=str(e))
             return None
 
+    async def _synthesize_and_read(self, text: str, output_file: Optional[str], read, sentence: bool = False):
+        """Synthesize text and return ``read(path)``.
+
+        A cache entry evicted by a concurrent put before it is read counts as a miss and is
+        synthesized again.
+        """
+        for attempt in range(2):
+            path = await self._synthesize(text, output_file, sentence)
+            if path is None:
+                return None
+            try:
+                return read(path)
+            except FileNotFoundError:
+                log.debug("tts.cache_evicted", path=str(path), attempt=attempt)
+        log.error("tts.error", error="Synthesized audio disappeared before it was read")
+        return None
+
+    def _use_sentences(self, text: str) -> bool:
+        return TTS_PARALLEL and len(split_sentences(text)) > 1
+
+    async def generate_speech(self, text: str):
+        started = time.perf_counter()
+        if self._use_sentences(text):
+            audio = await self.synthesize_sentences(text)
+            if audio is None:
+                return None
+            output_file = Path(self._new_output_file())
+            output_file.write_bytes(AudioProcessor.wav_bytes(*audio))
+        else:
+            output_file = await self._synthesize(text, self._new_output_file())
+            if output_file is None:
+                return None
+        record_stage("tts", time.perf_counter() - started)
+        log.debug("tts.audio", path=str(output_file))
+        return self._public_path(output_file)
+
+    async def generate_speech_bytes(self, text: str) -> Optional[bytes]:
+        """Synthesize text and return the WAV bytes without leaving a file in the output directory."""
+        if self._use_sentences(text):
+            started = time.perf_counter()
+            audio = await self.synthesize_sentences(text)
+            if audio is None:
+                return None
+            record_stage("tts", time.perf_counter() - started)
+            return AudioProcessor.wav_bytes(*audio)
+
+        scratch = None
+        if not self.cache:
+            fd, scratch = tempfile.mkstemp(suffix=".wav")
+            os.close(fd)
+        try:
+            return await self._synthesize_and_read(text, scratch, Path.read_bytes)
+        finally:
+            if scratch:
+                Path(scratch).unlink(missing_ok=True)
+
+    async def synthesize_pcm(self, text: str, sentence: bool = False) -> Optional[tuple]:
+        """Synthesize one segment and return ``(pcm, sample_rate, channels)`` as 16-bit PCM."""
+        scratch = None
+        if not self.cache:
+            fd, scratch = tempfile.mkstemp(suffix=".wav")
+            os.close(fd)
+        def read_pcm(path: Path) -> tuple:
+            with wave.open(str(path), 'rb') as wav:
+                return wav.readframes(wav.getnframes()), wav.getframerate(), wav.getnchannels()
+
+        try:
+            return await self._synthesize_and_read(text, scratch, read_pcm, sentence)
+        finally:
+            if scratch:
+                Path(scratch).unlink(missing_ok=True)
+
+    async def stream_pcm(self, text: str):
+        """Yield the PCM of each sentence, in order, as soon as it and the ones before it are done.
+
+        Up to one sentence per Piper worker is synthesized at a time (one with TTS_PARALLEL=0).
+        Edge silence is trimmed and a fixed TTS_SENTENCE_SILENCE pause starts every sentence
+        after the first, so pacing doesn't depend on how Piper padded each utterance.
+        """
+        if not await self.initialize():
+            return
+        sentences = split_sentences(text)
+        window = max(1, PIPER_WORKERS) if TTS_PARALLEL else 1
+        pending = deque()
+        next_index = 0
+        done = 0
+        first = True
+        started = time.perf_counter()
+        try:
+            while next_index < len(sentences) or pending:
+                while next_index < len(sentences) and len(pending) < window:
+                    pending.append(asyncio.ensure_future(self.synthesize_pcm(sentences[next_index], sentence=True)))
+                    next_index += 1
+                segment = await pending.popleft()
+                done += 1
+                if segment is None:
+                    # Skipping the sentence would play the reply with a gap in it
+                    log.error("tts.sentence_failed", sentence=done, sentences=len(sentences))
+                    raise SynthesisFailed(f"Sentence {done} of {len(sentences)} could not be synthesized")
+                pcm, sample_rate, channels = segment
+                if len(sentences) > 1:
+                    pcm = AudioProcessor.trim_silence(pcm, channels)
+                    if not first:
+                        pcm = AudioProcessor.silence(TTS_SENTENCE_SILENCE, sample_rate, channels) + pcm
+                first = False
+                yield pcm, sample_rate, channels
+            # One wall-clock span for all sentences; each sentence is also observed as tts_sentence
+            record_stage("tts_synthesis", time.perf_counter() - started)
+        finally:
+            # Closed early (client gone): drop the sentences still being synthesized
+            for task in pending:
+                task.cancel()
+
+    async def synthesize_sentences(self, text: str) -> Optional[tuple]:
+        """Synthesize sentences concurrently and join them in order into ``(pcm, sample_rate, channels)``.
+
+        Returns None if any sentence fails, rather than audio with a sentence missing.
+        """
+        parts = []
+        sample_rate = channels = None
+        try:
+            async for pcm, sample_rate, channels in self.stream_pcm(text):
+                parts.append(pcm)
+        except SynthesisFailed:
+            return None
+        if not parts:
+            return None
+        return b"".join(parts), sample_rate, channels
+
+    def stream_opus(self, text: str):
+        """Ogg/Opus pages for ``text``; the first arrive once the first sentence is synthesized."""
+        return AudioProcessor.stream_opus(self.stream_pcm(text))
+
+    def close(self):
+        if self.reaper:
+            self.reaper.stop()
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+        self.initialized = False
+
+
+# Waveform configuration
+WAVEFORM_RESOLUTION = 256
+WAVEFORM_CHUNK_SAMPLES = 64 * 1024
+
+class WaveformEnvelope:
+    """Incremental peak (and optionally RMS) envelope of a PCM stream over a fixed number of bins.
+
+    Sample ``p`` belongs to bin ``p * resolution // total_samples``; the first sample of
+    every bin is precomputed, so each fed chunk only needs a ``searchsorted`` over the bin
+    starts and one ``reduceat`` per statistic. Memory stays constant however long the
+    audio is. Samples past the expected total land in the last bin.
+    """
+    def __init__(self, total_samples, resolution=WAVEFORM_RESOLUTION, rms=False):
+        import numpy as np
+
+        self.total_samples = max(1, int(total_samples))
+        self.resolution = resolution
+        # First sample of bin k: ceil(k * total / resolution)
+        self.bin_starts = -(-np.arange(resolution, dtype=np.int64) * self.total_samples // resolution)
+        self.peaks = np.zeros(resolution, dtype=np.int32)
+        self.sum_squares = np.zeros(resolution, dtype=np.float64) if rms else None
+        self.counts = np.zeros(resolution, dtype=np.int64)
+        self.offset = 0
+
+    def feed(self, samples):
+        import numpy as np
+        n = len(samples)
+        if n == 0:
+            return
+        end = self.offset + n
+        # Bin of the first sample, then the bins that start inside this chunk
+        first = np.searchsorted(self.bin_starts, self.offset, side="right")
+        last = np.searchsorted(self.bin_starts, end, side="left")
+        bins = np.arange(first - 1, last)
+        starts = np.concatenate(([0], self.bin_starts[first:last] - self.offset))
+        if len(starts) > 1:
+            # Empty bins share a start with the next one; keep only the bin that has samples
+            keep = np.append(starts[1:] != starts[:-1], True)
+            bins, starts = bins[keep], starts[keep]
+        self.offset = end
+
+        # Max and min on int16 avoid widening every sample; abs(-32768) is taken in int32
+        peaks = np.maximum(
+            np.maximum.reduceat(samples, starts).astype(np.int32),
+            -np.minimum.reduceat(samples, starts).astype(np.int32)
+        )
+        self.peaks[bins] = np.maximum(self.peaks[bins], peaks)
+        self.counts[bins] += np.diff(np.append(starts, n))
+        if self.sum_squares is not None:
+            squares = samples.astype(np.float64)
+            squares *= squares
+            self.sum_squares[bins] += np.add.reduceat(squares, starts)
+
+    def rms(self):
+        import numpy as np
+        return np.sqrt(self.sum_squares / np.maximum(self.counts, 1))
+
+# Streamed Ogg/Opus: short pages so the first audio leaves as soon as it is encoded
+OPUS_STREAM_BITRATE = os.environ.get("OPUS_STREAM_BITRATE", "32k")
+OPUS_PAGE_DURATION_MS = int(os.environ.get("OPUS_PAGE_DURATION_MS", "100"))
+AUDIO_STREAM_CHUNK_BYTES = 4096
+
+# Samples quieter than this (16-bit) count as silence when trimming sentence edges
+SILENCE_THRESHOLD = 64
 
 class AudioProcessor:
+    @staticmethod
+    def trim_silence(pcm: bytes, channels: int = 1, threshold: int = SILENCE_THRESHOLD) -> bytes:
+        """Strip leading and trailing near-silent frames from 16-bit PCM (all-silent input is kept)."""
+        import numpy as np
+
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        loud = np.flatnonzero(np.abs(samples.astype(np.int32)) > threshold)
+        if len(loud) == 0:
+            return pcm
+        start = loud[0] - loud[0] % channels
+        end = loud[-1] - loud[-1] % channels + channels
+        return samples[start:end].tobytes()
+
+    @staticmethod
+    def silence(seconds: float, sample_rate: int, channels: int = 1) -> bytes:
+        return b"\x00\x00" * (int(seconds * sample_rate) * channels)
+
+    @staticmethod
+    def wav_bytes(pcm: bytes, sample_rate: int, channels: int = 1) -> bytes:
+        """Wrap 16-bit PCM in a WAV header."""
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(channels)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            wav.writeframes(pcm)
+        return buffer.getvalue()
+
+    @staticmethod
+    async def stream_opus(segments):
+        """Encode ``(pcm, sample_rate, channels)`` segments to Ogg/Opus with one ffmpeg process.
+
+        Encoded pages are yielded as ffmpeg writes them, while later segments are still
+        being produced. Closing the generator early kills ffmpeg and cancels the producer.
+        """
+        started = time.perf_counter()
+        segments = segments.__aiter__()
+        try:
+            pcm, sample_rate, channels = await segments.__anext__()
+        except StopAsyncIteration:
+            return
+
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg',
+            '-v', 'error',
+            '-f', 's16le',
+            '-ar', str(sample_rate),
+            '-ac', str(channels),
+            '-i', 'pipe:0',
+            '-c:a', 'libopus',
+            '-b:a', OPUS_STREAM_BITRATE,
+            '-application', 'voip',
+            '-page_duration', str(OPUS_PAGE_DURATION_MS * 1000),
+            '-flush_packets', '1',
+            '-f', 'ogg',
+            'pipe:1',
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+
+        async def feed():
+            try:
+                process.stdin.write(pcm)
+                await process.stdin.drain()
+                async for segment, _, _ in segments:
+                    process.stdin.write(segment)
+                    await process.stdin.drain()
+            finally:
+                process.stdin.close()
+
+        feeder = asyncio.ensure_future(feed())
+        first = True
+        try:
+            while True:
+                chunk = await process.stdout.read(AUDIO_STREAM_CHUNK_BYTES)
+                if not chunk:
+                    break
+                if first:
+                    record_stage("first_audio", time.perf_counter() - started)
+                    first = False
+                yield chunk
+            # Surface synthesis errors from the producer
+            await feeder
+        finally:
+            if not feeder.done():
+                feeder.cancel()
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+
+    @staticmethod
+    def read_wav_info(file_path):
+        """Read duration, sample rate and channels from a WAV header without spawning ffprobe."""
+        try:
+            with wave.open(str(file_path), 'rb') as wav:
+                sample_rate = wav.getframerate()
+                channels = wav.getnchannels()
+                duration = wav.getnframes() / float(sample_rate)
+            return duration, sample_rate, channels
+        except (wave.Error, EOFError, OSError):
+            return None
+
     @staticmethod
     def get_audio_info(file_path):
-        """Get audio duration and sample data using ffprobe."""
+        """Get audio duration and sample data from the WAV header, or with ffprobe for other formats."""
+        info = AudioProcessor.read_wav_info(file_path)
+        if info:
+            return info
+
         try:
             cmd = [
                 'ffprobe',
@@ -406,140 +2299,422 @@ class AudioProcessor:
             return 5.0, 48000, 1
 
     @staticmethod
-    def fast_convert_and_analyze(input_file, output_file):
-        """Convert to opus and analyze audio in a single ffmpeg pass."""
+    def normalize_waveform(envelope, resolution=WAVEFORM_RESOLUTION):
+        """Scale an envelope to 0-255, smooth it and keep a minimum visible amplitude."""
+        import numpy as np
+
+        max_val = np.max(envelope) if len(envelope) else 0
+        if max_val > 0:
+            waveform = (envelope / max_val * 255).astype(np.uint8)
+            # Apply smoothing
+            window_size = 3
+            smoothed = np.convolve(waveform, np.ones(window_size)/window_size, mode='same')
+            waveform = smoothed.astype(np.uint8)
+            # Ensure minimum amplitude
+            waveform = np.maximum(waveform, 10)
+        else:
+            waveform = np.full(resolution, 128, dtype=np.uint8)
+        return waveform
+
+    @staticmethod
+    def compute_waveform(stream, total_samples, resolution=WAVEFORM_RESOLUTION, kind="peak"):
+        """Read s16le mono PCM from a stream in fixed-size chunks and return the normalized envelope."""
+        import numpy as np
+
+        envelope = WaveformEnvelope(total_samples, resolution, rms=(kind == "rms"))
+        chunk_bytes = WAVEFORM_CHUNK_SAMPLES * 2
+        carry = b""
+        while True:
+            data = stream.read(chunk_bytes)
+            if not data:
+                break
+            if carry:
+                data = carry + data
+            # Keep an odd trailing byte for the next read
+            usable = len(data) - (len(data) % 2)
+            carry = data[usable:]
+            envelope.feed(np.frombuffer(data[:usable], dtype=np.int16))
+
+        values = envelope.rms() if kind == "rms" else envelope.peaks
+        return AudioProcessor.normalize_waveform(values, resolution)
+
+    @staticmethod
+    def fast_convert_and_analyze(input_file, output_file, resolution=WAVEFORM_RESOLUTION, kind="peak"):
+        """Convert to opus and analyze audio in a single ffmpeg pass.
+
+        ``kind`` selects the waveform envelope: ``"peak"`` or ``"rms"``.
+        """
+        started = time.perf_counter()
         try:
-            # Get audio info quickly
+            # Get audio info from the header (Piper writes plain WAV)
             duration, sample_rate, channels = AudioProcessor.get_audio_info(input_file)
 
-            # Get raw PCM data
+            # Decode once: encode the opus file and pipe mono PCM for the waveform
             cmd = [
                 'ffmpeg',
+                '-v', 'error',
+                '-y',
                 '-i', input_file,
                 '-vn',
-                '-ar', '48000',
+                '-c:a', 'libopus',
+                '-b:a', '64k',
+                output_file,
+                '-vn',
                 '-ac', '1',
                 '-f', 's16le',
                 '-acodec', 'pcm_s16le',
-                'pipe:1',
-                '-y'
+                'pipe:1'
             ]
             
-            process = subprocess.run(cmd, capture_output=True)
-            audio_data = np.frombuffer(process.stdout, dtype=np.int16)
-            
-            # Generate waveform
-            amplitudes = np.abs(audio_data)
-            segments = np.array_split(amplitudes, 256)
-            waveform = np.array([np.max(segment) if len(segment) > 0 else 0 for segment in segments])
-            
-            # Normalize to 0-255 range
-            max_val = np.max(waveform)
-            if max_val > 0:
-                waveform = (waveform / max_val * 255).astype(np.uint8)
-                # Apply smoothing
-                window_size = 3
-                smoothed = np.convolve(waveform, np.ones(window_size)/window_size, mode='same')
-                waveform = smoothed.astype(np.uint8)
-                # Ensure minimum amplitude
-                waveform = np.maximum(waveform, 10)
-            else:
-                waveform = np.full(256, 128, dtype=np.uint8)
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            try:
+                # Generate waveform while ffmpeg is still decoding, in constant memory
+                waveform = AudioProcessor.compute_waveform(
+                    process.stdout,
+                    int(round(duration * sample_rate)),
+                    resolution,
+                    kind
+                )
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
             
             # Convert to base64
-            waveform_base64 = base64.b64encode(bytes(waveform.tolist())).decode('utf-8')
-
-            # Convert to opus
-            subprocess.run([
-                'ffmpeg',
-                '-i', input_file,
-                '-c:a', 'libopus',
-                '-b:a', '64k',
-                output_file
-            ], check=True)
+            waveform_base64 = base64.b64encode(waveform.tobytes()).decode('utf-8')
 
+            record_stage("audio_postprocess", time.perf_counter() - started)
             return waveform_base64, duration
 
         except Exception as e:
             print(f"Error in fast convert and analyze: {e}")
-            return base64.b64encode(bytes([128] * 256)).decode('utf-8'), 5.0
+            return base64.b64encode(bytes([128] * resolution)).decode('utf-8'), 5.0
+
+class ChannelMessage(MessageRecord):
+    """One channel message; the ISO timestamp is only formatted when read."""
+    __slots__ = ("author", "content", "created_at", "is_bot")
+    fields = ("author", "content", "timestamp", "is_bot")
+
+    def __init__(self, author: str, content: str, created_at: datetime, is_bot: bool = False):
+        self.author = author
+        self.content = content
+        self.created_at = created_at
+        self.is_bot = is_bot
+
+    @property
+    def timestamp(self) -> str:
+        return self.created_at.isoformat()
 
 class ChannelContext:
     def __init__(self, max_messages=10):
-        self.messages = []
+        # Ring buffer: appending to a full deque drops the oldest message in O(1)
+        self.messages = deque(maxlen=max_messages)
         self.max_messages = max_messages
         self.last_bot_message = None
+        self._recent = None
+        self._transcript = None
     
     def add_message(self, message, is_bot=False):
-        message_data = {
-            'author': str(message.author),
-            'content': message.content,
-            'timestamp': message.created_at.isoformat(),
-            'is_bot': is_bot
-        }
+        message_data = ChannelMessage(str(message.author), message.content, message.created_at, is_bot)
         
         if is_bot:
             self.last_bot_message = message_data
             
         self.messages.append(message_data)
-        if len(self.messages) > self.max_messages:
-            self.messages.pop(0)
+        self._recent = None
+        self._transcript = None
+    
+    def recent_messages(self) -> List[ChannelMessage]:
+        """The last 10 messages, cached until the next message."""
+        if self._recent is None:
+            start = max(0, len(self.messages) - 10)
+            self._recent = [self.messages[i] for i in range(start, len(self.messages))]
+        return self._recent
+    
+    def transcript(self) -> str:
+        """Recent messages formatted for the analysis prompt, cached until the next message."""
+        if self._transcript is None:
+            self._transcript = "\n".join([
+                f"{msg.author}: {msg.content} {'(This was your message)' if msg.is_bot else ''}" 
+                for msg in self.recent_messages()
+            ])
+        return self._transcript
     
     def get_context(self):
         return {
-            'recent_messages': self.messages[-10:],
-            'last_bot_message': self.last_bot_message
+            'recent_messages': self.recent_messages(),
+            'last_bot_message': self.last_bot_message,
+            'transcript': self.transcript()
         }
 
     def was_last_message_from_bot(self):
-        return self.messages and self.messages[-1].get('is_bot', False)
+        return bool(self.messages) and self.messages[-1].is_bot
 
-class ConversationHistory:
-    def __init__(self, username="default"):
-        self.username = username
-        self.history_dir = Path("chat_history")
-        self.history_file = self.history_dir / f"{username}_history.pkl"
+# Chat history storage: "sqlite" (append-only, indexed) or "pickle" (legacy whole-file)
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "sqlite")
+HISTORY_DIR = Path(os.environ.get("HISTORY_DIR", "chat_history"))
+
+class PickleHistoryBackend:
+    """Legacy storage: one pickle per user, rewritten on every save."""
+    def __init__(self, history_dir: Path = HISTORY_DIR):
+        self.history_dir = history_dir
         self.history_dir.mkdir(exist_ok=True)
-        self.load_history()
 
-    def load_history(self):
-        if self.history_file.exists():
+    def _path(self, username: str) -> Path:
+        return self.history_dir / f"{username}_history.pkl"
+
+    def load_all(self, username: str) -> List[Dict]:
+        history_file = self._path(username)
+        if history_file.exists():
             try:
-                with open(self.history_file, 'rb') as f:
-                    self.conversations = pickle.load(f)
+                with open(history_file, 'rb') as f:
+                    return pickle.load(f)
             except Exception as e:
                 print(f"Error loading history: {e}")
-                self.conversations = []
-        else:
-            self.conversations = []
+        return []
 
-    def save_history(self):
+    def append(self, username: str, conversation: Dict) -> None:
+        conversations = self.load_all(username)
+        conversations.append(conversation)
         try:
-            with open(self.history_file, 'wb') as f:
-                pickle.dump(self.conversations, f)
+            with open(self._path(username), 'wb') as f:
+                pickle.dump(conversations, f)
         except Exception as e:
             print(f"Error saving history: {e}")
 
+    def recent(self, username: str, limit: int) -> List[Dict]:
+        return self.load_all(username)[-limit:]
+
+class SQLiteHistoryBackend:
+    """Append-only storage in SQLite (WAL mode) with an index for recent-N reads.
+
+    Saves and recent-context loads cost the same however long a user's history is.
+    Legacy pickles are imported the first time a user is opened and then renamed.
+    """
+    def __init__(self, history_dir: Path = HISTORY_DIR):
+        self.history_dir = history_dir
+        self.history_dir.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.migrated = set()
+        self.connection = sqlite3.connect(
+            str(self.history_dir / "history.sqlite3"),
+            check_same_thread=False
+        )
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    messages TEXT NOT NULL
+                )
+            """)
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations (username, id)"
+            )
+            self.connection.commit()
+
+    @staticmethod
+    def _encode(conversation: Dict):
+        timestamp = conversation['timestamp']
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.isoformat()
+        return str(timestamp), json.dumps(conversation['messages'], default=str)
+
+    @staticmethod
+    def _decode(row) -> Dict:
+        timestamp, messages = row
+        try:
+            timestamp = datetime.fromisoformat(timestamp)
+        except ValueError:
+            pass
+        return {'timestamp': timestamp, 'messages': json.loads(messages)}
+
+    def migrate_pickle(self, username: str) -> int:
+        """Import a legacy ``<username>_history.pkl`` once; return the number of conversations imported.
+
+        Runs entirely under the lock, so a concurrent reader waits for the import instead of
+        seeing an empty history. The pickle is renamed only after it was read and inserted;
+        an unreadable one is left in place (and retried after a restart).
+        """
+        if username in self.migrated:
+            return 0
+        with self.lock:
+            if username in self.migrated:
+                return 0
+            pickle_path = PickleHistoryBackend(self.history_dir)._path(username)
+            if not pickle_path.exists():
+                self.migrated.add(username)
+                return 0
+
+            try:
+                with open(pickle_path, 'rb') as f:
+                    conversations = pickle.load(f)
+                self.connection.executemany(
+                    "INSERT INTO conversations (username, timestamp, messages) VALUES (?, ?, ?)",
+                    [(username, *self._encode(convo)) for convo in conversations]
+                )
+                self.connection.commit()
+            except Exception as e:
+                self.connection.rollback()
+                print(f"Error migrating history for {username}: {e}")
+                self.migrated.add(username)
+                return 0
+            pickle_path.rename(pickle_path.with_name(pickle_path.name + ".migrated"))
+            self.migrated.add(username)
+        print(f"Migrated {len(conversations)} conversations for {username} to SQLite")
+        return len(conversations)
+
+    def load_all(self, username: str) -> List[Dict]:
+        self.migrate_pickle(username)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT timestamp, messages FROM conversations WHERE username = ? ORDER BY id",
+                (username,)
+            ).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def append(self, username: str, conversation: Dict) -> None:
+        self.migrate_pickle(username)
+        try:
+            with self.lock:
+                self.connection.execute(
+                    "INSERT INTO conversations (username, timestamp, messages) VALUES (?, ?, ?)",
+                    (username, *self._encode(conversation))
+                )
+                self.connection.commit()
+        except Exception as e:
+            print(f"Error saving history: {e}")
+
+    def recent(self, username: str, limit: int) -> List[Dict]:
+        self.migrate_pickle(username)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT timestamp, messages FROM conversations WHERE username = ? ORDER BY id DESC LIMIT ?",
+                (username, limit)
+            ).fetchall()
+        return [self._decode(row) for row in reversed(rows)]
+
+_history_backend = None
+
+def get_history_backend():
+    """Return the process-wide history backend selected by HISTORY_BACKEND."""
+    global _history_backend
+    if _history_backend is None:
+        if HISTORY_BACKEND == "pickle":
+            _history_backend = PickleHistoryBackend()
+        else:
+            _history_backend = SQLiteHistoryBackend()
+    return _history_backend
+
+class ConversationHistory:
+    def __init__(self, username="default", backend=None):
+        self.username = username
+        self.backend = backend or get_history_backend()
+
+    @property
+    def conversations(self) -> List[Dict]:
+        """All conversations of the user; prefer get_recent_context for the hot path."""
+        return self.backend.load_all(self.username)
+
+    def load_history(self):
+        return self.conversations
+
+    def save_history(self):
+        # Conversations are persisted as they are added
+        pass
+
     def add_conversation(self, messages):
         conversation = {
             'timestamp': datetime.now(),
             'messages': messages
         }
-        self.conversations.append(conversation)
-        self.save_history()
+        self.backend.append(self.username, conversation)
 
     def get_recent_context(self, limit=5):
         context = []
-        if self.conversations:
-            recent_convos = self.conversations[-limit:]
-            for convo in recent_convos:
-                context.extend(convo['messages'])
+        for convo in self.backend.recent(self.username, limit):
+            context.extend(convo['messages'])
         return context
 
+# Background conversation analysis
+ANALYSIS_CONCURRENCY = int(os.environ.get("ANALYSIS_CONCURRENCY", "1"))
+ANALYSIS_BUSY_POLL = 0.25
+
+ANALYSIS_JOBS_TOTAL = METRICS.register(Counter(
+    "analysis_jobs_total",
+    "Background analysis jobs by outcome (done, coalesced, error).",
+    labelnames=("outcome",)
+))
+
+class AnalysisQueue:
+    """Low-priority background queue for conversation analysis.
+
+    Jobs are keyed by channel: a new request for a channel that is still queued replaces
+    the queued one and shares its result. At most ``concurrency`` jobs run at once, and
+    workers hold back while ``is_busy()`` reports that interactive chat needs the model.
+    """
+    def __init__(self, concurrency: int = ANALYSIS_CONCURRENCY, is_busy=None):
+        self.concurrency = max(1, concurrency)
+        self.is_busy = is_busy or (lambda: False)
+        self.pending = {}
+        self.queue = None
+        self.workers = []
+
+    def submit(self, key, job) -> "asyncio.Future":
+        """Queue ``job`` (a coroutine function) under ``key``; return a future for its result."""
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+        entry = self.pending.get(key)
+        if entry is not None:
+            # Still waiting: analyze only the newest message for this channel
+            entry[0] = job
+            ANALYSIS_JOBS_TOTAL.inc("coalesced")
+            return entry[1]
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = [job, future]
+        self.queue.put_nowait(key)
+        return future
+
+    async def _worker(self):
+        while True:
+            key = await self.queue.get()
+            while self.is_busy():
+                await asyncio.sleep(ANALYSIS_BUSY_POLL)
+            job, future = self.pending.pop(key)
+            started = time.perf_counter()
+            try:
+                result = await job()
+                ANALYSIS_JOBS_TOTAL.inc("done")
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                ANALYSIS_JOBS_TOTAL.inc("error")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - started, "analysis")
+                self.queue.task_done()
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        self.queue = None
+
+analysis_queue = None
+
 class ChatSession:
     def __init__(self, username="default"):
         self.history = ConversationHistory(username)
         self.messages = []
+        self.insights = {}
         
         self.messages.append({
             'role': 'system',
@@ -550,17 +2725,17 @@ class ChatSession:
         if recent_context:
             self.messages.extend(recent_context)
 
-    async def analyze_message(self, message_content, author, context):
-        try:
-            recent_messages = context['recent_messages']
-            last_bot_message = context['last_bot_message']
-            
+    @staticmethod
+    def build_analysis_prompt(message_content, author, context) -> str:
+        last_bot_message = context['last_bot_message']
+        messages_str = context.get('transcript')
+        if messages_str is None:
             messages_str = "\n".join([
                 f"{msg['author']}: {msg['content']} {'(This was your message)' if msg.get('is_bot') else ''}" 
-                for msg in recent_messages
+                for msg in context['recent_messages']
             ])
-            
-            prompt = f"""Analyze the following conversation context and provide insights:
+        
+        return f"""Analyze the following conversation context and provide insights:
 
 Recent Messages:
 {messages_str}
@@ -572,109 +2747,674 @@ Current Message:
 {author}: {message_content}
 
 Analysis:"""
+
+    async def analyze_message(self, message_content, author, context):
+        try:
+            prompt = self.build_analysis_prompt(message_content, author, context)
             
-            response = ollama.chat(
-                model="llama3.1:8b",
-                messages=[{"role": "user", "content": prompt}]
-            )
+            async with get_ollama_backends().session() as backend:
+                response = await backend.async_client.chat(
+                    model="llama3.1:8b",
+                    messages=[{"role": "user", "content": prompt}],
+                    keep_alive=OLLAMA_KEEP_ALIVE
+                )
             
             return response['message']['content']
         except Exception as e:
-            print(f"Error analyzing message: {e}")
+            log.error("analysis.error", error=str(e))
             return "Analysis failed."
 
+    def queue_analysis(self, channel_id, message_content, author, context) -> "asyncio.Future":
+        """Analyze in the background; the result is also kept in ``insights[channel_id]``."""
+        global analysis_queue
+        if analysis_queue is None:
+            analysis_queue = AnalysisQueue()
+
+        async def job():
+            insight = await self.analyze_message(message_content, author, context)
+            self.insights[channel_id] = insight
+            return insight
+
+        return analysis_queue.submit(channel_id, job)
+
+# Context window configuration
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3072"))
+CONTEXT_MAX_MESSAGES = int(os.environ.get("CONTEXT_MAX_MESSAGES", "50"))
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "0"))  # 0 disables summaries
+# When the context is over budget (or history is full), trim down to this fraction in one go
+CONTEXT_LOW_WATER = float(os.environ.get("CONTEXT_LOW_WATER", "0.75"))
+MESSAGE_TOKEN_OVERHEAD = 4  # role and template tokens around each chat message
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: about four characters per token for English text."""
+    return max(1, (len(text) + 3) // 4) + MESSAGE_TOKEN_OVERHEAD
+
+def summarize_turns(messages, max_tokens: int) -> str:
+    """Condense dropped turns to their first sentence, newest first, within max_tokens."""
+    lines = []
+    used = 0
+    for msg in reversed(messages):
+        snippet = msg["content"].strip().split("\n", 1)[0]
+        for end in (". ", "? ", "! "):
+            if end in snippet:
+                snippet = snippet.split(end, 1)[0] + end.strip()
+                break
+        line = f"{msg['role']}: {snippet[:200]}"
+        cost = estimate_tokens(line)
+        if used + cost > max_tokens:
+            break
+        lines.append(line)
+        used += cost
+    lines.reverse()
+    return "\n".join(lines)
+
+# Model residency and prompt-cache configuration
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_WARMUP = os.environ.get("OLLAMA_WARMUP", "1") == "1"
+
+class PromptCacheStats:
+    """How much of each prompt Ollama evaluated versus reused from its prefix cache.
+
+    Ollama reports ``prompt_eval_count`` as the prompt tokens it actually processed, so
+    comparing it with the estimated prompt size shows how well the prefix is reused.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.evaluated_tokens = 0
+        self.eval_duration_ns = 0
+
+    def record(self, prompt_tokens: int, response) -> None:
+        evaluated = response.get('prompt_eval_count')
+        if evaluated is None:
+            return
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.evaluated_tokens += evaluated
+        self.eval_duration_ns += response.get('prompt_eval_duration') or 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        reuse = 0.0
+        if self.prompt_tokens:
+            reuse = min(1.0, max(0.0, 1 - self.evaluated_tokens / self.prompt_tokens))
+        return {
+            "requests": self.requests,
+            "prompt_tokens_estimated": self.prompt_tokens,
+            "prompt_tokens_evaluated": self.evaluated_tokens,
+            "reuse_ratio": round(reuse, 3),
+            "avg_prompt_eval_ms": round(self.eval_duration_ns / self.requests / 1e6, 2) if self.requests else 0.0
+        }
+
+# Ollama backends: OLLAMA_HOSTS lists several servers, otherwise the client default (OLLAMA_HOST) is used
+OLLAMA_HOSTS = [host.strip() for host in os.environ.get("OLLAMA_HOSTS", "").split(",") if host.strip()]
+OLLAMA_EJECT_FAILURES = int(os.environ.get("OLLAMA_EJECT_FAILURES", "3"))
+OLLAMA_EJECT_SECONDS = float(os.environ.get("OLLAMA_EJECT_SECONDS", "30"))
+OLLAMA_HEALTH_INTERVAL = float(os.environ.get("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_HEALTH_TIMEOUT = float(os.environ.get("OLLAMA_HEALTH_TIMEOUT", "3"))
+OLLAMA_STICKY_SLACK = int(os.environ.get("OLLAMA_STICKY_SLACK", "2"))
+OLLAMA_STICKY_SESSIONS = 10000
+LATENCY_EWMA_WEIGHT = 0.2
+
+class OllamaBackend:
+    """One Ollama server with its clients, load and health state."""
+    def __init__(self, host: Optional[str] = None):
+        self.host = host
+        self.name = host or os.environ.get("OLLAMA_HOST", "default")
+        self.client = ollama.Client(host=host)
+        self.async_client = ollama.AsyncClient(host=host)
+        self.in_flight = 0
+        self.latency = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "host": self.name,
+            "healthy": self.healthy(time.monotonic()),
+            "in_flight": self.in_flight,
+            "latency_ms": round(self.latency * 1000, 1),
+            "requests": self.requests,
+            "failures": self.failures
+        }
+
+class OllamaBackendPool:
+    """Routes each call to the least-loaded healthy backend.
+
+    Backends are ranked by in-flight requests, then by recent latency. A session keeps
+    its previous backend, whose prompt cache already holds its prefix, unless that backend
+    is unhealthy or more than ``sticky_slack`` requests busier than the best one.
+    Failed calls and active checks eject a backend for ``eject_seconds``; when every
+    backend is ejected the pool still routes to the one that recovers first.
+    """
+    def __init__(
+        self,
+        hosts: Optional[List[str]] = None,
+        eject_failures: int = OLLAMA_EJECT_FAILURES,
+        eject_seconds: float = OLLAMA_EJECT_SECONDS,
+        sticky_slack: int = OLLAMA_STICKY_SLACK
+    ):
+        self.backends = [OllamaBackend(host) for host in (hosts or [None])]
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.sticky_slack = sticky_slack
+        self.sticky = OrderedDict()
+        self.lock = threading.Lock()
+
+    def pick(self, session_key: Optional[str] = None) -> OllamaBackend:
+        """Choose a backend and count the call as in flight on it."""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b.healthy(now)]
+            if not candidates:
+                candidates = [min(self.backends, key=lambda b: b.ejected_until)]
+            backend = min(candidates, key=lambda b: (b.in_flight, b.latency))
+            if session_key is not None:
+                previous = self.sticky.get(session_key)
+                if (previous in candidates
+                        and previous.in_flight <= backend.in_flight + self.sticky_slack):
+                    backend = previous
+                self.sticky[session_key] = backend
+                self.sticky.move_to_end(session_key)
+                if len(self.sticky) > OLLAMA_STICKY_SESSIONS:
+                    self.sticky.popitem(last=False)
+            backend.in_flight += 1
+            return backend
+
+    @staticmethod
+    def is_backend_failure(error: Exception) -> bool:
+        """Connection problems and server errors count against a backend; bad requests do not."""
+        status = getattr(error, "status_code", None)
+        return not (isinstance(error, ollama.ResponseError) and status is not None and 0 < status < 500)
+
+    def release(self, backend: OllamaBackend, seconds: float, error: Optional[Exception] = None) -> None:
+        with self.lock:
+            backend.in_flight -= 1
+            backend.requests += 1
+            if error is not None and self.is_backend_failure(error):
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.eject_failures:
+                    self._eject(backend, error)
+                return
+            backend.consecutive_failures = 0
+            backend.latency = seconds if not backend.latency else (
+                LATENCY_EWMA_WEIGHT * seconds + (1 - LATENCY_EWMA_WEIGHT) * backend.latency
+            )
+
+    def _eject(self, backend: OllamaBackend, error: Exception) -> None:
+        if len(self.backends) > 1 and backend.healthy(time.monotonic()):
+            print(f"Ejecting Ollama backend {backend.name} for {self.eject_seconds:.0f}s: {str(error)}")
+        backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    @asynccontextmanager
+    async def session(self, session_key: Optional[str] = None):
+        """Hold a backend for one async call (or one whole stream)."""
+        backend = self.pick(session_key)
+        started = time.perf_counter()
+        try:
+            yield backend
+        except Exception as e:
+            self.release(backend, time.perf_counter() - started, e)
+            raise
+        except BaseException:
+            # Cancelled or closed early: free the slot without judging the backend
+            with self.lock:
+                backend.in_flight -= 1
+            raise
+        else:
+            self.release(backend, time.perf_counter() - started)
+
+    @contextmanager
+    def sync_session(self, session_key: Optional[str] = None):
+        """Blocking counterpart of session() for the Streamlit UI."""
+        backend = self.pick(session_key)
+        started = time.perf_counter()
+        try:
+            yield backend
+        except Exception as e:
+            self.release(backend, time.perf_counter() - started, e)
+            raise
+        except BaseException:
+            with self.lock:
+                backend.in_flight -= 1
+            raise
+        else:
+            self.release(backend, time.perf_counter() - started)
+
+    async def check_backend(self, backend: OllamaBackend) -> bool:
+        """Active check: list models with a short timeout; reinstate or eject the backend."""
+        try:
+            await asyncio.wait_for(backend.async_client.list(), timeout=OLLAMA_HEALTH_TIMEOUT)
+        except Exception as e:
+            with self.lock:
+                backend.failures += 1
+                self._eject(backend, e)
+            return False
+        with self.lock:
+            if not backend.healthy(time.monotonic()):
+                print(f"Ollama backend {backend.name} is healthy again")
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0.0
+        return True
+
+    async def check_health(self) -> int:
+        """Check every backend concurrently; return how many are healthy."""
+        results = await asyncio.gather(*(self.check_backend(b) for b in self.backends))
+        return sum(results)
+
+    async def run_health_checks(self, interval: float = OLLAMA_HEALTH_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_health()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [backend.snapshot() for backend in self.backends]
+
+_ollama_backends = None
+
+def get_ollama_backends() -> OllamaBackendPool:
+    """Return the process-wide Ollama backend pool built from OLLAMA_HOSTS."""
+    global _ollama_backends
+    if _ollama_backends is None:
+        _ollama_backends = OllamaBackendPool(OLLAMA_HOSTS)
+    return _ollama_backends
+
+METRICS.register(Gauge(
+    "ollama_backend_in_flight",
+    "Requests currently running on each Ollama backend.",
+    lambda: {(b.name,): b.in_flight for b in _ollama_backends.backends} if _ollama_backends else None,
+    labelnames=("backend",)
+))
+METRICS.register(Gauge(
+    "ollama_backend_healthy",
+    "1 when the Ollama backend is in rotation, 0 while it is ejected.",
+    lambda: {
+        (b.name,): int(b.healthy(time.monotonic())) for b in _ollama_backends.backends
+    } if _ollama_backends else None,
+    labelnames=("backend",)
+))
+
+# Response cache for context-free opening turns; RESPONSE_CACHE_SIZE=0 disables it
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_VARIANTS = int(os.environ.get("RESPONSE_CACHE_VARIANTS", "3"))
+RESPONSE_CACHE_MAX_CHARS = int(os.environ.get("RESPONSE_CACHE_MAX_CHARS", "200"))
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0"))  # 0 means exact matches only
+RESPONSE_EMBEDDING_DIM = 256
+
+RESPONSE_CACHE_TOTAL = METRICS.register(Counter(
+    "response_cache_total",
+    "Opening-turn response cache lookups by result (hit, near_hit, miss).",
+    labelnames=("result",)
+))
+
+class ResponseCache:
+    """LRU/TTL cache of model replies to first messages sent without any history.
+
+    Keys are (persona hash, model, normalized message). Each key collects
+    ``variants`` generated replies before it starts answering, then samples one per hit
+    so repeated openers do not always get the same text. With ``similarity`` above 0,
+    a miss falls back to the nearest cached message of the same persona and model by
+    cosine similarity of hashed character-trigram vectors.
+    """
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL,
+        variants: int = RESPONSE_CACHE_VARIANTS,
+        similarity: float = RESPONSE_CACHE_SIMILARITY,
+        max_chars: int = RESPONSE_CACHE_MAX_CHARS
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.similarity = similarity
+        self.max_chars = max_chars
+        # key -> [created, replies, vector]
+        self.entries = OrderedDict()
+        # namespace -> (keys, matrix), rebuilt after entries of that namespace change
+        self.indexes = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        """Lowercase, drop punctuation and collapse whitespace: "Hi!!" and "hi" share a key."""
+        return " ".join("".join(ch if ch.isalnum() or ch == "'" else " " for ch in message.lower()).split())
+
+    def key(self, system_message: str, model: str, message: str) -> Optional[tuple]:
+        """Cache key for a message, or None when it is too long to be a common opener."""
+        text = self.normalize(message)
+        if not text or len(text) > self.max_chars:
+            return None
+        persona = hashlib.sha256(system_message.encode("utf-8")).hexdigest()[:16]
+        return (f"{persona}:{model}", text)
+
+    @staticmethod
+    def embed(text: str):
+        """Unit vector of hashed character trigrams; cheap enough to compute per request."""
+        import numpy as np
+
+        vector = np.zeros(RESPONSE_EMBEDDING_DIM, dtype=np.float32)
+        padded = f" {text} "
+        for i in range(len(padded) - 2):
+            vector[hash(padded[i:i + 3]) % RESPONSE_EMBEDDING_DIM] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expired(self, entry) -> bool:
+        return time.monotonic() - entry[0] > self.ttl
+
+    def _remove(self, key: tuple) -> None:
+        del self.entries[key]
+        self.indexes.pop(key[0], None)
+
+    def _nearest(self, key: tuple) -> Optional[tuple]:
+        import numpy as np
+
+        namespace = key[0]
+        index = self.indexes.get(namespace)
+        if index is None:
+            keys = [k for k in self.entries if k[0] == namespace]
+            matrix = np.stack([self.entries[k][2] for k in keys]) if keys else None
+            index = self.indexes[namespace] = (keys, matrix)
+        keys, matrix = index
+        if matrix is None:
+            return None
+        scores = matrix @ self.embed(key[1])
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.similarity else None
+
+    def get(self, key: tuple) -> Optional[str]:
+        """A cached reply for the key (or a near duplicate), or None on a miss."""
+        with self.lock:
+            result = "hit"
+            if key not in self.entries and self.similarity > 0:
+                near = self._nearest(key)
+                if near is not None:
+                    key, result = near, "near_hit"
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is None or len(entry[1]) < self.variants:
+                self.misses += 1
+                RESPONSE_CACHE_TOTAL.inc("miss")
+                return None
+            self.entries.move_to_end(key)
+            if result == "hit":
+                self.hits += 1
+            else:
+                self.near_hits += 1
+            RESPONSE_CACHE_TOTAL.inc(result)
+            return random.choice(entry[1])
+
+    def put(self, key: tuple, reply: str) -> None:
+        """Remember a freshly generated reply as one of the key's variants."""
+        if not reply:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry):
+                vector = self.embed(key[1]) if self.similarity > 0 else None
+                entry = self.entries[key] = [time.monotonic(), [], vector]
+                self.indexes.pop(key[0], None)
+            if len(entry[1]) < self.variants:
+                entry[1].append(reply)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.indexes.pop(evicted[0], None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "entries": len(self.entries)
+        }
+
+RESPONSE_CACHE = ResponseCache() if RESPONSE_CACHE_SIZE > 0 else None
+
 class ChatClient:
     def __init__(
         self,
         model: str = "llama3.1:8b",
-        max_history: int = 10,
-        system_message: str = DEFAULT_WAIFU_PROMPT
+        max_history: int = CONTEXT_MAX_MESSAGES,
+        system_message: str = DEFAULT_WAIFU_PROMPT,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        summary_tokens: int = CONTEXT_SUMMARY_TOKENS,
+        tts: Optional["PiperTTS"] = None,
+        backends: Optional[OllamaBackendPool] = None
     ):
         self.model = model
         self.max_history = max_history
-        self.conversation_history = deque(maxlen=max_history)
+        self.conversation_history = MessageHistory(maxlen=max_history)
         self.system_message = system_message
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self._system_tokens = 0
+        self._system_tokens_source = None
+        self._system_api = None
+        self.keep_alive = OLLAMA_KEEP_ALIVE
+        self.prompt_cache = PromptCacheStats()
+        self.response_cache = RESPONSE_CACHE
         self.mood = "happy"
-        self.tts = PiperTTS()
-        
-        # Verify model availability
+        self.kaomoji_freq = 0.7
+        # Pass a shared PiperTTS to avoid one engine (and worker pool) per client
+        self.tts = tts or PiperTTS()
+        self.backends = backends or get_ollama_backends()
+        # Sticky routing key for this client's own history; API sessions pass their session_id
+        self.session_key = uuid.uuid4().hex
+        # Model availability is checked by check_model/prepare, not here, so startup never blocks on Ollama
+        self.ready = False
+        self.readiness_error = None
+
+    @staticmethod
+    def _connection_help(error: Exception) -> str:
+        return (
+            f"Failed to connect to Ollama: {str(error)}. Please make sure: "
+            "1. Ollama service is running (try 'ollama serve' in a new terminal) "
+            "2. The model is pulled using: ollama pull llama3.1:8b "
+            "3. You have sufficient system resources available"
+        )
+
+    def verify_model(self) -> None:
+        """Check synchronously that Ollama is running and has the model (no generation)."""
         try:
-            print(f"Attempting to connect to Ollama model: {self.model}")
-            # First try to list models to verify Ollama is running
-            models = ollama.list()
-            print(f"Available models: {models}")
-            
-            # Then try to make a test request
-            response = ollama.chat(
-                model=self.model,
-                messages=[{"role": "user", "content": "test"}]
-            )
-            print(f"Successfully connected to Ollama model: {self.model}")
-            print(f"Test response: {response}")
+            with self.backends.sync_session() as backend:
+                backend.client.show(self.model)
         except Exception as e:
             print(f"Error connecting to Ollama: {str(e)}")
-            print("Please make sure:")
-            print("1. Ollama service is running (try 'ollama serve' in a new terminal)")
-            print("2. The model is pulled using: ollama pull llama3.1:8b")
-            print("3. You have sufficient system resources available")
-            raise Exception(f"Failed to connect to Ollama: {str(e)}")
+            raise Exception(self._connection_help(e))
+
+    async def check_model(self) -> bool:
+        """Non-blocking check that at least one Ollama backend is reachable and has the model pulled."""
+        results = await asyncio.gather(
+            *(backend.async_client.show(self.model) for backend in self.backends.backends),
+            return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if len(errors) < len(results):
+            self.readiness_error = None
+            return True
+        self.readiness_error = self._connection_help(errors[0])
+        return False
+
+    async def prepare(self) -> bool:
+        """Background startup: check the model, optionally warm it up, then mark the client ready."""
+        if not await self.check_model():
+            print(f"Ollama model {self.model} not available yet: {self.readiness_error}")
+            return False
+        if OLLAMA_WARMUP:
+            await self.warm_up()
+        self.ready = True
+        print(f"Ollama model {self.model} is ready")
+        return True
     
     def detect_mood(self, text: str) -> str:
         """Simple mood detection from text content."""
-        mood_keywords = {
-            "happy": ["happy", "joy", "excited", "wonderful", "great", "yay", "nice", "よかった", "うれしい"],
-            "sad": ["sad", "sorry", "unfortunate", "regret", "apologize", "ごめん", "すみません"],
-            "surprised": ["wow", "oh", "amazing", "incredible", "unexpected", "すごい", "えっ"],
-            "love": ["love", "adore", "appreciate", "care", "好き", "大好き"],
-            "thinking": ["think", "consider", "maybe", "perhaps", "possibly", "そうですね"],
-            "excited": ["fantastic", "awesome", "excellent", "brilliant", "わくわく"],
-            "apologetic": ["sorry", "apologize", "regret", "mistake", "申し訳ない"],
-            "playful": ["hehe", "fun", "play", "joke", "うふふ", "えへへ"],
-            "sleepy": ["tired", "sleep", "rest", "yawn", "眠い", "疲れた"],
-            "determined": ["will", "must", "definitely", "certainly", "頑張る", "できる"]
-        }
-        
-        text = text.lower()
-        for mood, keywords in mood_keywords.items():
-            if any(keyword in text for keyword in keywords):
-                return mood
-        return "happy"  # default mood
+        return MOOD_MATCHER.detect(text)
+
+    def pick_kaomoji(self, mood: str) -> Optional[str]:
+        """Pick a kaomoji for the mood, or None when this reply should not get one."""
+        if random.random() < self.kaomoji_freq:
+            return random.choice(KAOMOJI.get(mood, KAOMOJI["happy"]))
+        return None
 
     def add_kaomoji(self, text: str, mood: Optional[str] = None) -> str:
         """Add a contextually appropriate kaomoji to the text."""
-        if random.random() < st.session_state.get("kaomoji_freq", 0.7):  # Use session state for frequency
-            if not mood:
-                mood = self.detect_mood(text)
-            kaomoji = random.choice(KAOMOJI.get(mood, KAOMOJI["happy"]))
+        kaomoji = self.pick_kaomoji(mood or self.detect_mood(text))
+        if kaomoji:
             return f"{text} {kaomoji}"
         return text
 
-    def add_to_history(self, role: str, content: str) -> None:
-        """Add a message to the conversation history."""
-        self.conversation_history.append({
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        })
-
-    def get_messages_for_api(self) -> List[Dict[str, str]]:
-        """Format the conversation history for the API."""
-        messages = [
-            {
-                "role": "system",
-                "content": self.system_message
-            }
-        ]
+    def add_to_history(self, role: str, content: str, history: Optional[deque] = None) -> None:
+        """Add a message to the conversation history (or to a session's history)."""
+        if history is None:
+            history = self.conversation_history
+        history.append(ChatMessage(role, content, estimate_tokens(content)))
+
+    def drop_user_turn(self, content: str, history: Optional[deque] = None) -> None:
+        """Remove an unanswered user turn so an abandoned request leaves the history as it was."""
+        if history is None:
+            history = self.conversation_history
+        if history and history[-1].role == "user" and history[-1].content == content:
+            history.pop()
+
+    def system_api_message(self) -> Dict[str, str]:
+        """The pinned system prompt in API form, rebuilt only when the prompt changes."""
+        if self._system_api is None or self._system_api["content"] is not self.system_message:
+            self._system_api = {"role": "system", "content": self.system_message}
+        return self._system_api
+
+    def system_tokens(self) -> int:
+        """Token estimate of the system prompt, recomputed only when the prompt changes."""
+        if self._system_tokens_source is not self.system_message:
+            self._system_tokens = estimate_tokens(self.system_message)
+            self._system_tokens_source = self.system_message
+        return self._system_tokens
+
+    def select_context(self, history) -> tuple:
+        """Split history into (dropped, kept) so kept turns fit the token budget.
+
+        The window starts where the previous trim left it for as long as it fits. Once it
+        doesn't, old turns are dropped in one block down to CONTEXT_LOW_WATER of the budget,
+        so the prompt prefix changes once every few turns instead of on every turn.
+        The newest message is always kept, even when it alone exceeds the budget.
+        """
+        budget = self.token_budget - self.system_tokens()
+        if self.summary_tokens > 0:
+            budget -= self.summary_tokens
+        messages = list(history)
+        costs = [msg.tokens or estimate_tokens(msg.content) for msg in messages]
+        head = getattr(history, "context_head", None)
+        split = 0
+        if head is not None:
+            for index, msg in enumerate(messages):
+                if msg is head:
+                    split = index
+                    break
+
+        if sum(costs[split:]) > budget:
+            target = budget * CONTEXT_LOW_WATER
+            kept = 0
+            used = 0
+            for cost in reversed(costs):
+                if kept and used + cost > target:
+                    break
+                used += cost
+                kept += 1
+            split = len(messages) - kept
+
+        if isinstance(history, MessageHistory):
+            history.context_head = messages[split] if split < len(messages) else None
+        return messages[:split], messages[split:]
+
+    def get_messages_for_api(self, history: Optional[deque] = None) -> List[Dict[str, str]]:
+        """Format the conversation history (or a session's history) for the API.
+
+        The system prompt is always sent; older turns are dropped (or summarized when
+        summary_tokens is set) once the context would exceed token_budget. The result is
+        cached on the history until its next append, so callers must not modify it.
+        """
+        if history is None:
+            history = self.conversation_history
+        view_key = (self.system_message, self.token_budget, self.summary_tokens)
+        if getattr(history, "api_view", None) is not None and history.api_view_key == view_key:
+            return history.api_view
         
-        messages.extend([
-            {
-                "role": msg["role"],
-                "content": msg["content"]
-            } for msg in self.conversation_history
-        ])
+        dropped, kept = self.select_context(history)
+        messages = [self.system_api_message()]
+        
+        if dropped and self.summary_tokens > 0:
+            summary = summarize_turns(dropped, self.summary_tokens)
+            if summary:
+                messages.append({
+                    "role": "system",
+                    "content": f"Summary of earlier conversation:\n{summary}"
+                })
+        
+        messages.extend([msg.as_api() for msg in kept])
         
+        if isinstance(history, MessageHistory):
+            history.api_view = messages
+            history.api_view_key = view_key
         return messages
 
+    @staticmethod
+    def prompt_tokens(messages: List[Dict[str, str]]) -> int:
+        return sum(estimate_tokens(msg["content"]) for msg in messages)
+
+    def response_cache_key(self, message: str, history: Optional[deque] = None) -> Optional[tuple]:
+        """Response cache key for an opening turn; None with history, when caching is off,
+        or for a crisis message, which must always get a reply written for it.
+        """
+        if history is None:
+            history = self.conversation_history
+        if self.response_cache is None or history or is_crisis_message(message):
+            return None
+        return self.response_cache.key(self.system_message, self.model, message)
+
+    def cached_reply(self, cache_key: Optional[tuple], history: Optional[deque] = None) -> Optional[str]:
+        """Look up a cached opening reply and record it in history like a generated one."""
+        if cache_key is None:
+            return None
+        reply = self.response_cache.get(cache_key)
+        if reply is not None:
+            self.add_to_history("assistant", reply, history)
+        return reply
+
+    async def warm_up(self, temperature: float = 0.7) -> bool:
+        """Load the model and evaluate the system prompt so the first real turn hits a warm prefix cache."""
+        async def warm(backend: OllamaBackend) -> bool:
+            try:
+                await backend.async_client.chat(
+                    model=self.model,
+                    messages=[{"role": "system", "content": self.system_message}],
+                    keep_alive=self.keep_alive,
+                    options={
+                        "temperature": temperature,
+                        "num_predict": 1,
+                    }
+                )
+                print(f"Warmed up Ollama model: {self.model} on {backend.name}")
+                return True
+            except Exception as e:
+                print(f"Model warm-up on {backend.name} failed (non-critical): {str(e)}")
+                return False
+
+        # Every backend may serve any session, so warm them all
+        results = await asyncio.gather(*(warm(backend) for backend in self.backends.backends))
+        return any(results)
+
     def create_chat_completion(
         self,
         message: str,
@@ -683,33 +3423,187 @@ class ChatClient:
     ):
         """Create a chat completion with streaming support."""
         try:
-            print(f"Creating chat completion for message: {message}")
+            log.debug("completion.start", model=self.model, stream=stream, chars=len(message))
+            cache_key = None if stream else self.response_cache_key(message)
             self.add_to_history("user", message)
+            cached = self.cached_reply(cache_key)
+            if cached is not None:
+                return self.add_kaomoji(cached)
             messages = self.get_messages_for_api()
             
-            print("Sending request to Ollama...")
-            response = ollama.chat(
+            if stream:
+                return self._stream_completion(messages, temperature)
+            
+            with self.backends.sync_session(self.session_key) as backend:
+                response = backend.client.chat(
+                    model=self.model,
+                    messages=messages,
+                    keep_alive=self.keep_alive,
+                    options={
+                        "temperature": temperature,
+                    }
+                )
+            
+            response_content = response['message']['content']
+            log.debug("completion.done", model=self.model, chars=len(response_content), response=response_content)
+            self.prompt_cache.record(self.prompt_tokens(messages), response)
+            # Keep the model's own text in history so the next prompt prefix matches byte for byte
+            self.add_to_history("assistant", response_content)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, response_content)
+            return self.add_kaomoji(response_content)
+                
+        except Exception as e:
+            log.error("completion.error", model=self.model, error_type=type(e).__name__, error=str(e))
+            raise Exception(f"Failed to generate response: {str(e)}")
+
+    async def acreate_chat_completion(
+        self,
+        message: str,
+        temperature: float = 0.7,
+        history: Optional[deque] = None,
+        session_key: Optional[str] = None
+    ) -> str:
+        """Create a chat completion without blocking the event loop.
+
+        ``history`` lets API sessions keep their own context while sharing this client;
+        ``session_key`` keeps each session on the same Ollama backend.
+        """
+        try:
+            log.debug("completion.start", model=self.model, stream=False, chars=len(message))
+            cache_key = self.response_cache_key(message, history)
+            self.add_to_history("user", message, history)
+            cached = self.cached_reply(cache_key, history)
+            if cached is not None:
+                return self.add_kaomoji(cached)
+            messages = self.get_messages_for_api(history)
+            
+            started = time.perf_counter()
+            async with self.backends.session(session_key or self.session_key) as backend:
+                response = await backend.async_client.chat(
+                    model=self.model,
+                    messages=messages,
+                    keep_alive=self.keep_alive,
+                    options={
+                        "temperature": temperature,
+                    }
+                )
+            record_stage("generation", time.perf_counter() - started)
+            # Without streaming, TTFT is the model load plus prompt evaluation reported by Ollama
+            ttft_ns = (response.get('load_duration') or 0) + (response.get('prompt_eval_duration') or 0)
+            if ttft_ns:
+                record_stage("ttft", ttft_ns / 1e9)
+            record_generation_stats(response)
+            
+            response_content = response['message']['content']
+            log.debug("completion.done", model=self.model, chars=len(response_content), response=response_content)
+            self.prompt_cache.record(self.prompt_tokens(messages), response)
+            # Keep the model's own text in history so the next prompt prefix matches byte for byte
+            self.add_to_history("assistant", response_content, history)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, response_content)
+            return self.add_kaomoji(response_content)
+        
+        except asyncio.CancelledError:
+            # Closing the connection makes Ollama stop generating
+            CANCELLED_TOTAL.inc("generation")
+            self.drop_user_turn(message, history)
+            raise
+        except Exception as e:
+            log.error("completion.error", model=self.model, error_type=type(e).__name__, error=str(e))
+            raise Exception(f"Failed to generate response: {str(e)}")
+
+    async def acreate_streaming_chat_completion(
+        self,
+        message: str,
+        temperature: float = 0.7,
+        history: Optional[deque] = None,
+        session_key: Optional[str] = None
+    ):
+        """Yield ``token`` events as Ollama streams, then a ``done`` event with mood and kaomoji."""
+        cache_key = self.response_cache_key(message, history)
+        self.add_to_history("user", message, history)
+        cached = self.cached_reply(cache_key, history)
+        if cached is not None:
+            yield {"type": "token", "content": cached}
+            mood = self.detect_mood(cached)
+            kaomoji = self.pick_kaomoji(mood)
+            yield {
+                "type": "done",
+                "response": f"{cached} {kaomoji}" if kaomoji else cached,
+                "mood": mood,
+                "kaomoji": kaomoji
+            }
+            return
+        messages = self.get_messages_for_api(history)
+        
+        started = time.perf_counter()
+        full_response = []
+        mood_scanner = MOOD_MATCHER.scanner()
+        # The backend stays in use until the whole stream has been read
+        try:
+            async with self.backends.session(session_key or self.session_key) as backend:
+                stream = await backend.async_client.chat(
+                    model=self.model,
+                    messages=messages,
+                    stream=True,
+                    keep_alive=self.keep_alive,
+                    options={
+                        "temperature": temperature,
+                    }
+                )
+                
+                try:
+                    async for chunk in stream:
+                        if 'message' in chunk and 'content' in chunk['message']:
+                            content = chunk['message']['content']
+                            if content:
+                                if not full_response:
+                                    record_stage("ttft", time.perf_counter() - started)
+                                full_response.append(content)
+                                mood_scanner.feed(content)
+                                yield {"type": "token", "content": content}
+                        if chunk.get('done'):
+                            self.prompt_cache.record(self.prompt_tokens(messages), chunk)
+                            record_generation_stats(chunk)
+                except (asyncio.CancelledError, GeneratorExit):
+                    CANCELLED_TOTAL.inc("generation")
+                    raise
+                finally:
+                    # Close the HTTP stream now, not at garbage collection, so Ollama stops generating
+                    await stream.aclose()
+        except (asyncio.CancelledError, GeneratorExit):
+            self.drop_user_turn(message, history)
+            raise
+        record_stage("generation", time.perf_counter() - started)
+        
+        complete_response = "".join(full_response)
+        self.add_to_history("assistant", complete_response, history)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, complete_response)
+        mood = mood_scanner.mood
+        kaomoji = self.pick_kaomoji(mood)
+        if kaomoji:
+            complete_response = f"{complete_response} {kaomoji}"
+        yield {
+            "type": "done",
+            "response": complete_response,
+            "mood": mood,
+            "kaomoji": kaomoji
+        }
+
+    def _stream_completion(self, messages: List[Dict[str, str]], temperature: float):
+        """Stream raw Ollama chunks, holding one backend until the stream is consumed."""
+        with self.backends.sync_session(self.session_key) as backend:
+            yield from backend.client.chat(
                 model=self.model,
                 messages=messages,
-                stream=stream,
+                stream=True,
+                keep_alive=self.keep_alive,
                 options={
                     "temperature": temperature,
                 }
             )
-            
-            if not stream:
-                response_content = response['message']['content']
-                print(f"Received response: {response_content}")
-                response_content = self.add_kaomoji(response_content)
-                self.add_to_history("assistant", response_content)
-                return response_content
-            else:
-                return response
-                
-        except Exception as e:
-            print(f"Error in create_chat_completion: {str(e)}")
-            print(f"Full error details: {type(e).__name__}: {str(e)}")
-            raise Exception(f"Failed to generate response: {str(e)}")
 
     def create_streaming_chat_completion(
         self,
@@ -717,6 +3611,14 @@ class ChatClient:
         temperature: float = 0.7
     ):
         """Create a streaming chat completion that yields chunks of the response."""
+        cache_key = self.response_cache_key(message)
+        cached = self.response_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            self.add_to_history("user", message)
+            self.add_to_history("assistant", cached)
+            self.mood = self.detect_mood(cached)
+            yield cached
+            return
         response = self.create_chat_completion(
             message=message,
             temperature=temperature,
@@ -725,7 +3627,7 @@ class ChatClient:
         
         if response:
             full_response = []
-            current_mood = "happy"
+            mood_scanner = MOOD_MATCHER.scanner()
             
             try:
                 for chunk in response:
@@ -734,26 +3636,27 @@ class ChatClient:
                         full_response.append(content)
                         yield content
                         
-                        # Update mood based on accumulated response
-                        current_text = "".join(full_response)
-                        current_mood = self.detect_mood(current_text)
+                        # Update mood incrementally; matches may span chunk boundaries
+                        self.mood = mood_scanner.feed(content)
                 
                 complete_response = "".join(full_response)
-                complete_response = self.add_kaomoji(complete_response, current_mood)
                 self.add_to_history("assistant", complete_response)
+                if cache_key is not None:
+                    self.response_cache.put(cache_key, complete_response)
                 
             except Exception as e:
+                import streamlit as st
                 st.error(f"Error in streaming response: {str(e)}")
                 
     def get_conversation_history(self, include_timestamps: bool = False) -> List[Dict]:
         """Get the current conversation history."""
         if include_timestamps:
-            return list(self.conversation_history)
+            return [msg.as_dict() for msg in self.conversation_history]
         
         return [
             {
-                "role": msg["role"],
-                "content": msg["content"]
+                "role": msg.role,
+                "content": msg.content
             } for msg in self.conversation_history
         ]
 
@@ -765,8 +3668,30 @@ class ChatClient:
         """Generate TTS audio from text."""
         return await self.tts.generate_speech(text)
 
+    async def generate_tts_bytes(self, text: str) -> Optional[bytes]:
+        """Generate TTS audio from text as in-memory WAV bytes."""
+        return await self.tts.generate_speech_bytes(text)
+
+class SharedResources:
+    """Heavy, process-wide objects reused by every Streamlit session."""
+    def __init__(self):
+        self.tts = PiperTTS()
+        self.verified_models = set()
+        self.lock = threading.Lock()
+
+    def verify_model(self, chat_client: ChatClient) -> None:
+        """Check a model with Ollama once per process instead of once per session."""
+        if chat_client.model in self.verified_models:
+            return
+        with self.lock:
+            if chat_client.model not in self.verified_models:
+                chat_client.verify_model()
+                self.verified_models.add(chat_client.model)
+
 def apply_custom_css(theme_name: str):
     """Apply custom CSS styling based on selected theme."""
+    import streamlit as st
+
     theme = THEMES.get(theme_name, THEMES["Default"])
     
     st.markdown(f"""
@@ -816,6 +3741,8 @@ def apply_custom_css(theme_name: str):
 
 def initialize_session_state():
     """Initialize Streamlit session state variables."""
+    import streamlit as st
+
     if "messages" not in st.session_state:
         st.session_state.messages = []
     if "chat_client" not in st.session_state:
@@ -835,6 +3762,8 @@ def initialize_session_state():
 
 def create_sidebar():
     """Create and handle sidebar elements."""
+    import streamlit as st
+
     with st.sidebar:
         st.title(" 🤔 Therapy Settings")
         
@@ -872,6 +3801,8 @@ def create_sidebar():
             st.success("Chat history cleared! Start a new conversation~")
 
 def main():
+    import streamlit as st
+
     st.set_page_config(
         page_title="Therapy Chat",
         page_icon=" 💬",
@@ -885,17 +3816,32 @@ def main():
     st.title("Therapy Chat")
     st.markdown(f"Currently chatting with **{WAIFU_PERSONAS[st.session_state.selected_persona]['name']}** using Mentalhealth_model:latest")
     
-    # Initialize or update chat client if needed
-    if not st.session_state.chat_client or st.session_state.model_changed:
-        try:
-            st.session_state.chat_client = ChatClient(
-                model=st.session_state.selected_model,
-                system_message=st.session_state.custom_prompt
-            )
-            st.session_state.model_changed = False
-        except Exception as e:
-            st.error(f"Error initializing model: {str(e)}")
-            return
+    # The TTS engine and model checks are shared by every browser session
+    @st.cache_resource(show_spinner=False)
+    def shared_resources():
+        return SharedResources()
+
+    resources = shared_resources()
+
+    # Initialize the per-session client once; it only holds this user's history
+    if not st.session_state.chat_client:
+        st.session_state.chat_client = ChatClient(
+            model=st.session_state.selected_model,
+            system_message=st.session_state.custom_prompt,
+            tts=resources.tts
+        )
+
+    # Persona and model switches are plain attribute updates, not a reconnect
+    chat_client = st.session_state.chat_client
+    chat_client.model = st.session_state.selected_model
+    chat_client.system_message = st.session_state.custom_prompt
+    chat_client.kaomoji_freq = st.session_state.kaomoji_freq
+    try:
+        resources.verify_model(chat_client)
+        st.session_state.model_changed = False
+    except Exception as e:
+        st.error(f"Error initializing model: {str(e)}")
+        return
 
     # Display chat messages
     for message in st.session_state.messages:
@@ -939,12 +3885,16 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--mode", choices=["streamlit", "api"], default="streamlit")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8501)
     args = parser.parse_args()
 
     if args.mode == "api":
+        import uvicorn
+
         # Run FastAPI server
-        print("Starting FastAPI server on port 8501...")
-        uvicorn.run(app, host="0.0.0.0", port=8501)
+        print(f"Starting FastAPI server on port {args.port}...")
+        uvicorn.run(app, host=args.host, port=args.port)
     else:
         # Run Streamlit app
         main()
\ No newline at end of file
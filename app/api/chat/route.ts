@@ -3,7 +3,7 @@ import { NextResponse } from "next/server"
 // This is a placeholder API route that would connect to your Python backend
 export async function POST(request: Request) {
   try {
-    const { message } = await request.json()
+    const { message, session_id } = await request.json()
     console.log("Sending request to Python backend:", message)
 
     // Forward the request to Python backend
@@ -12,7 +12,8 @@ export async function POST(request: Request) {
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ message })
+      // Pass the session along so the backend keeps this conversation's context
+      body: JSON.stringify({ message, session_id })
     })
 
     if (!response.ok) {
@@ -33,6 +34,12 @@ export async function POST(request: Request) {
     if (data.audio) {
       // Assuming the audio file is accessible via a static URL
       data.audio = `http://localhost:8501/static/${data.audio.split('/').pop()}`
+    } else if (data.audio_stream) {
+      // Streaming audio mode returns a URL that plays while the reply is still being synthesized
+      data.audio = `http://localhost:8501${data.audio_stream}`
+    } else if (data.audio_data) {
+      // Inline audio mode returns the WAV bytes instead of a file path
+      data.audio = `data:${data.audio_mime || 'audio/wav'};base64,${data.audio_data}`
     }
 
     return NextResponse.json(data)
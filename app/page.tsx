@@ -19,6 +19,8 @@ export default function Home() {
   const [isDarkMode, setIsDarkMode] = useState(true)
   const [isSidebarOpen, setIsSidebarOpen] = useState(false)
   const audioRef = useRef<HTMLAudioElement>(null)
+  // Conversation id assigned by the backend on the first reply
+  const sessionIdRef = useRef<string | null>(null)
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" })
@@ -43,7 +45,7 @@ export default function Home() {
         headers: {
           "Content-Type": "application/json",
         },
-        body: JSON.stringify({ message: input }),
+        body: JSON.stringify({ message: input, session_id: sessionIdRef.current ?? undefined }),
       })
 
       if (!response.ok) {
@@ -56,6 +58,10 @@ export default function Home() {
         throw new Error(data.error)
       }
 
+      if (data.session_id) {
+        sessionIdRef.current = data.session_id
+      }
+
       setMessages((prev) => [...prev, { 
         role: "assistant", 
         content: data.response,
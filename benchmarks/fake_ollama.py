@@ -0,0 +1,145 @@
+"""Stand-in for the Ollama HTTP API with configurable latency, for offline benchmarks.
+
+Serves the endpoints app.py uses (/api/chat, /api/show, /api/tags, /api/version).
+Chat replies wait --ttft seconds before the first chunk, then stream
+--response-tokens tokens at --tokens-per-second in chunks of --chunk-tokens.
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("I hear you and it sounds like today has been heavy. "
+         "Let's take a slow breath together and notice what you are feeling right now. ").split()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body or b"{}")
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [{"name": self.config.model, "model": self.config.model}]})
+        elif self.path == "/api/version":
+            self._send_json({"version": "0.0.0-fake"})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        request = self._read_json()
+        if self.path == "/api/show":
+            self._send_json({
+                "modelfile": "",
+                "parameters": "",
+                "template": "",
+                "details": {},
+                "model_info": {},
+                "capabilities": ["completion"],
+            })
+        elif self.path == "/api/chat":
+            self._chat(request)
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _chat(self, request):
+        config = self.config
+        prompt_tokens = sum(len(msg.get("content", "")) // 4 for msg in request.get("messages", []))
+        tokens = config.response_tokens
+        num_predict = (request.get("options") or {}).get("num_predict")
+        if num_predict:
+            tokens = min(tokens, int(num_predict))
+        pieces = [WORDS[i % len(WORDS)] + " " for i in range(tokens)]
+
+        started = time.perf_counter()
+        time.sleep(config.ttft)
+        delay = config.chunk_tokens / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        final = {
+            "model": request.get("model", config.model),
+            "created_at": "2024-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(config.ttft * 1e9),
+            "eval_count": tokens,
+        }
+
+        if not request.get("stream", True):
+            time.sleep(delay * max(0, (tokens - 1) // config.chunk_tokens))
+            final["message"]["content"] = "".join(pieces)
+            final["total_duration"] = int((time.perf_counter() - started) * 1e9)
+            self._send_json(final)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, tokens, config.chunk_tokens):
+            if start:
+                time.sleep(delay)
+            chunk = {
+                "model": final["model"],
+                "created_at": final["created_at"],
+                "message": {"role": "assistant", "content": "".join(pieces[start:start + config.chunk_tokens])},
+                "done": False,
+            }
+            self._write_chunk(json.dumps(chunk) + "\n")
+        final["total_duration"] = int((time.perf_counter() - started) * 1e9)
+        self._write_chunk(json.dumps(final) + "\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--model", default="llama3.1:8b")
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--response-tokens", type=int, default=120)
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="tokens per streamed chunk")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    args.chunk_tokens = max(1, args.chunk_tokens)
+    FakeOllamaHandler.config = args
+    server = ThreadingHTTPServer((args.host, args.port), FakeOllamaHandler)
+    server.daemon_threads = True
+    print(f"Fake Ollama listening on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
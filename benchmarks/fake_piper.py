@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Stand-in for `piper --json-input` with a configurable synthesis delay, for offline benchmarks.
+
+Reads one JSON request per line on stdin, sleeps FAKE_PIPER_DELAY seconds plus
+FAKE_PIPER_DELAY_PER_CHAR per character, writes a silent 16-bit mono WAV to
+"output_file" and prints its path, like the real binary.
+"""
+import json
+import os
+import sys
+import time
+import wave
+
+SAMPLE_RATE = 22050
+SECONDS_PER_CHAR = 0.06
+
+
+def synthesize(text, output_file):
+    frames = int(len(text) * SECONDS_PER_CHAR * SAMPLE_RATE)
+    with wave.open(output_file, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b"\x00\x00" * frames)
+
+
+def main():
+    delay = float(os.environ.get("FAKE_PIPER_DELAY", "0.2"))
+    delay_per_char = float(os.environ.get("FAKE_PIPER_DELAY_PER_CHAR", "0.0005"))
+    # Model and config flags are accepted and ignored
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        request = json.loads(line)
+        text = request.get("text", "")
+        output_file = request.get("output_file") or f"{int(time.time() * 1000)}.wav"
+        time.sleep(delay + delay_per_char * len(text))
+        synthesize(text, output_file)
+        print(output_file, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""End-to-end load test of the FastAPI mode against local Ollama and Piper stand-ins.
+
+Starts benchmarks/fake_ollama.py and `app.py --mode api` (with benchmarks/fake_piper.py
+as the Piper binary) in a scratch directory, drives /chat and /chat/stream at the
+requested concurrency and prints a JSON report with throughput, latency percentiles,
+time-to-first-token and error rates. Runs offline; needs the packages in requirements.txt.
+
+    python benchmarks/run_benchmark.py --concurrency 16 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+APP_PATH = BENCH_DIR.parent / "app.py"
+
+MESSAGES = [
+    "hi",
+    "I feel anxious about my exams",
+    "I can't sleep at night and I keep overthinking",
+    "Can you suggest a grounding exercise?",
+    "I had an argument with my family today",
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples, errors, statuses, elapsed):
+    latencies = [sample["latency"] for sample in samples]
+    ttfts = [sample["ttft"] for sample in samples if sample.get("ttft") is not None]
+    total = len(samples) + errors
+    report = {
+        "requests": total,
+        "succeeded": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "status_codes": statuses,
+        "throughput_rps": round(len(samples) / elapsed, 3) if elapsed > 0 else 0.0,
+        "latency_s": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+    }
+    if ttfts:
+        report["ttft_s"] = {f"p{p}": percentile(ttfts, p) for p in (50, 95, 99)}
+    return report
+
+
+async def chat_once(client, message, session_id):
+    started = time.perf_counter()
+    response = await client.post("/chat", json={"message": message, "session_id": session_id})
+    latency = time.perf_counter() - started
+    body = response.json() if response.status_code == 200 else None
+    ok = isinstance(body, dict) and "error" not in body
+    return ok, response.status_code, {"latency": latency}
+
+
+async def stream_once(client, message, session_id):
+    started = time.perf_counter()
+    ttft = None
+    done = False
+    async with client.stream("POST", "/chat/stream", json={"message": message, "session_id": session_id}) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return False, response.status_code, None
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[6:])
+            if event["type"] == "token" and ttft is None:
+                ttft = time.perf_counter() - started
+            elif event["type"] == "done":
+                done = True
+            elif event["type"] == "error":
+                return False, response.status_code, None
+    return done, response.status_code, {"latency": time.perf_counter() - started, "ttft": ttft}
+
+
+async def drive(base_url, endpoint, concurrency, total_requests, timeout):
+    """Run total_requests against one endpoint with a fixed number of concurrent workers."""
+    request_fn = stream_once if endpoint == "/chat/stream" else chat_once
+    samples = []
+    statuses = {}
+    errors = 0
+    counter = iter(range(total_requests))
+
+    async def worker(index, client):
+        nonlocal errors
+        for n in counter:
+            message = MESSAGES[n % len(MESSAGES)]
+            try:
+                ok, status, sample = await request_fn(client, message, f"bench-{index}")
+            except Exception as e:
+                ok, status, sample = False, type(e).__name__, None
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if ok:
+                samples.append(sample)
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i, client) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    report = summarize(samples, errors, statuses, elapsed)
+    report["endpoint"] = endpoint
+    report["concurrency"] = concurrency
+    report["elapsed_s"] = round(elapsed, 3)
+    return report
+
+
+def wait_ready(base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/readyz", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{base_url} did not become ready within {timeout}s")
+
+
+def start_services(args, workdir):
+    ollama_ports = [free_port() for _ in range(max(1, args.backends))]
+    app_port = free_port()
+    quiet = None if args.verbose else subprocess.DEVNULL
+
+    fake_ollamas = [
+        subprocess.Popen(
+            [
+                sys.executable, str(BENCH_DIR / "fake_ollama.py"),
+                "--port", str(port),
+                "--ttft", str(args.ttft),
+                "--tokens-per-second", str(args.tokens_per_second),
+                "--response-tokens", str(args.response_tokens),
+                "--chunk-tokens", str(args.chunk_tokens),
+            ],
+            stdout=quiet, stderr=quiet
+        )
+        for port in ollama_ports
+    ]
+    hosts = [f"http://127.0.0.1:{port}" for port in ollama_ports]
+
+    fake_piper = BENCH_DIR / "fake_piper.py"
+    fake_piper.chmod(fake_piper.stat().st_mode | 0o111)
+    env = dict(
+        os.environ,
+        OLLAMA_HOST=hosts[0],
+        OLLAMA_HOSTS=",".join(hosts) if len(hosts) > 1 else "",
+        PIPER_BINARY=str(fake_piper),
+        PIPER_MODEL=str(Path(workdir) / "fake.onnx"),
+        PIPER_CONFIG=str(Path(workdir) / "fake.onnx.json"),
+        FAKE_PIPER_DELAY=str(args.piper_delay),
+        TTS_CACHE_MAX_BYTES=str(args.tts_cache_bytes),
+        PYTHONUNBUFFERED="1",
+    )
+    env.update(dict(item.split("=", 1) for item in args.env))
+    app = subprocess.Popen(
+        [sys.executable, str(APP_PATH), "--mode", "api", "--host", "127.0.0.1", "--port", str(app_port)],
+        cwd=workdir, env=env, stdout=quiet, stderr=quiet
+    )
+    return fake_ollamas + [app], f"http://127.0.0.1:{app_port}"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Load-test the API mode against local stand-ins.")
+    parser.add_argument("--endpoints", nargs="+", default=["/chat", "/chat/stream"])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--response-tokens", type=int, default=120)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--backends", type=int, default=1, help="fake Ollama servers behind OLLAMA_HOSTS")
+    parser.add_argument("--piper-delay", type=float, default=0.2)
+    parser.add_argument("--tts-cache-bytes", type=int, default=0, help="0 measures uncached synthesis")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for app.py, e.g. CHAT_MAX_IN_FLIGHT=16")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the services' output")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="mh-bench-") as workdir:
+        try:
+            if args.url:
+                base_url = args.url.rstrip("/")
+            else:
+                processes, base_url = start_services(args, workdir)
+            wait_ready(base_url, timeout=60)
+
+            report = {
+                "config": {
+                    key: value for key, value in vars(args).items()
+                    if key not in ("output", "verbose")
+                },
+                "results": [
+                    asyncio.run(drive(base_url, endpoint, args.concurrency, args.requests, args.timeout))
+                    for endpoint in args.endpoints
+                ],
+            }
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()